@@ -3,18 +3,19 @@
 #the full copyright notices and license terms.
 import os
 import ConfigParser
+import hashlib
+import mimetypes
 import time
 import datetime
 import pytz
-import logging
 
-from flask import Flask, render_template, request, g, send_from_directory, \
-    url_for, session
+from flask import Flask, current_app, render_template, request, g, \
+    send_file, safe_join, session, abort, Response, stream_with_context
 from flask_babel import Babel, gettext as _
-from werkzeug.contrib.cache import FileSystemCache
 from werkzeug.contrib.fixers import ProxyFix
 from werkzeug.debug import DebuggedApplication
-from logging.handlers import SMTPHandler
+from cache import create_cache
+from thumbnails import ThumbnailEngine
 
 path = os.path.dirname(os.path.realpath(__file__))
 
@@ -23,8 +24,9 @@ if hasattr(time, 'tzset'):
     time.tzset()
 
 def get_config():
-    '''Get configuration from cfg file'''
-    conf_file = '%s/config.ini' % os.path.dirname(os.path.realpath(__file__))
+    '''Get configuration from cfg file (GALATEA_CONFIG_INI to override)'''
+    conf_file = os.environ.get('GALATEA_CONFIG_INI',
+        '%s/config.ini' % os.path.dirname(os.path.realpath(__file__)))
     config = ConfigParser.ConfigParser()
     config.read(conf_file)
 
@@ -35,15 +37,6 @@ def get_config():
             results[section][option] = config.get(section, option)
     return results
 
-def create_app(config=None):
-    '''Create Flask APP'''
-    cfg = get_config()
-    app_name = cfg['flask']['app_name']
-    app = Flask(app_name)
-    app.config.from_pyfile(config)
-
-    return app
-
 def parse_setup(filename):
     globalsdict = {}  # put predefined things herec
     localsdict = {}  # will be populated by executed script
@@ -51,52 +44,14 @@ def parse_setup(filename):
     return localsdict
 
 def get_default_lang():
-    return app.config.get('LANGUAGE')
+    return current_app.config.get('LANGUAGE')
 
 def get_languages():
-    languages = app.config.get('ACCEPT_LANGUAGES')
+    languages = current_app.config.get('ACCEPT_LANGUAGES')
     if not languages:
         return None
     return [k.split('_')[0] for k, v in languages.iteritems()]
 
-conf_file = '%s/config.cfg' % path
-
-app = create_app(conf_file)
-app.config['BABEL_DEFAULT_LOCALE'] = get_default_lang()
-app.root_path = os.path.dirname(os.path.abspath(__file__))
-
-TIMEZONE = None
-if app.config.get('TIMEZONE'):
-    TIMEZONE = pytz.timezone(app.config.get('TIMEZONE'))
-
-babel = Babel(app)
-app.cache = FileSystemCache(cache_dir=app.config['CACHE_DIR'], default_timeout=app.config['CACHE_TIMEOUT'])
-
-if app.config.get('DEBUG'):
-    app.wsgi_app = DebuggedApplication(app.wsgi_app, True)
-
-# tryton transaction
-ctx = app.app_context()
-ctx.push()
-from galatea.tryton import tryton
-
-from galatea.sessions import GalateaSessionInterface
-app.session_interface = GalateaSessionInterface()
-
-from galatea.helpers import cached, login_required
-from galatea.utils import get_tryton_language, get_tryton_locale
-
-# register Blueprints - modules
-from galatea import galatea
-app.register_blueprint(galatea, url_prefix='/<lang>')
-from galatea_file import galatea_file
-app.register_blueprint(galatea_file)
-
-# context procesors and filters
-import context_processors
-import defaultfilters
-
-@babel.localeselector
 def get_locale():
     lang = request.path[1:].split('/', 1)[0]
     if lang in get_languages():
@@ -104,92 +59,234 @@ def get_locale():
     else:
         return get_default_lang()
 
-@app.before_request
 def func():
-    g.babel = babel
+    now = datetime.datetime.now(current_app.timezone)
+    g.babel = current_app.extensions['babel']
     g.language = get_locale()
-    g.today = datetime.datetime.now(TIMEZONE).date()
-    g.now = datetime.datetime.now(TIMEZONE)
+    g.today = now.date()
+    g.now = now
+
+def share_tryton(app, tryton):
+    '''Set up for app the Tryton object initialized with another app'''
+    app.config.setdefault('TRYTON_USER', 0)
+    app.extensions['Tryton'] = tryton
+    try:
+        from flask_tryton import RecordConverter, RecordsConverter
+    except ImportError:
+        return
+    app.url_map.converters['record'] = RecordConverter
+    app.url_map.converters['records'] = RecordsConverter
 
-@app.errorhandler(404)
-@tryton.transaction()
 def page_not_found(e):
     return render_template('404.html'), 404
 
-@app.errorhandler(500)
 def server_error(e):
     return render_template('500.html'), 500
 
-@tryton.default_context
 def default_context():
+    from galatea.utils import get_tryton_language, get_tryton_locale
+
+    config = current_app.config
     context = {}
     context['language'] = get_tryton_language(g.language)
     context['locale'] = get_tryton_locale(g.language)
-    context['company'] = app.config.get('TRYTON_COMPANY')
-    context['shop'] = app.config.get('TRYTON_SALE_SHOP')
-    context['shops'] = app.config.get('TRYTON_SALE_SHOPS')
-    context['locations'] = app.config.get('TRYTON_LOCATIONS')
+    context['company'] = config.get('TRYTON_COMPANY')
+    context['shop'] = config.get('TRYTON_SALE_SHOP')
+    context['shops'] = config.get('TRYTON_SALE_SHOPS')
+    context['locations'] = config.get('TRYTON_LOCATIONS')
     context['customer'] = session.get('customer', None)
     return context
 
-@app.route('/')
-@app.route("/en/", endpoint="en")
-@app.route("/es/", endpoint="es")
-@app.route("/ca/", endpoint="ca")
-@tryton.transaction()
 def index():
     '''Home'''
     return render_template('index.html')
 
-@app.route('/sitemap.xml')
-@tryton.transaction()
-@cached(3500, 'sitemap')
 def sitemap():
-    '''Sitemap: Generate Sitemap XML'''
-    galatea_website = app.config.get('TRYTON_GALATEA_SITE')
-    shops = app.config.get('TRYTON_SALE_SHOPS')
-
-    Article = tryton.pool.get('galatea.cms.article')
-    Template = tryton.pool.get('product.template')
-
-    locs = []
-    # Articles
-    articles = Article.search_read([
-        ('active', '=', True),
-        ('galatea_website', '=', galatea_website),
-        ], fields_names = ['slug_langs'])
-    for article in articles:
-        for k, v in article['slug_langs'].items():
-            locale = k[:2]
-            locs.append(url_for('cms.article', lang=locale, slug=v))
-
-    # Products
-    products = Template.search_read([
-        ('esale_active', '=', True),
-        ('esale_saleshops', 'in', shops),
-        ], fields_names = ['esale_slug_langs'])
-    for product in products:
-        for k, v in product['esale_slug_langs'].items():
-            locale = k[:2]
-            locs.append(url_for('catalog.product_'+locale, lang=locale, slug=v))
-
-    return render_template('sitemap.xml', locs=locs)
-
-@app.route('/media/cache/<filename>')
+    '''Sitemap: Sitemap index XML'''
+    from sitemap import cached_sitemap_pages, sitemap_index_xml, \
+        serve_sitemap
+
+    response = serve_sitemap('sitemap.xml')
+    if response:
+        return response
+    pages = cached_sitemap_pages()
+    return Response(stream_with_context(sitemap_index_xml(pages)),
+        mimetype='application/xml')
+
+def sitemap_page(name, page):
+    '''Sitemap: Generate Sitemap XML of articles or products by page'''
+    from sitemap import sitemap_sources, cached_sitemap_pages, \
+        sitemap_xml, serve_sitemap
+
+    if name not in sitemap_sources() or page < 1:
+        abort(404)
+    response = serve_sitemap('sitemap-%s-%s.xml' % (name, page))
+    if response:
+        return response
+    # pages of the sitemap index only
+    pages = cached_sitemap_pages()
+    if (name, page) not in pages:
+        abort(404)
+    return Response(stream_with_context(sitemap_xml(name, page)),
+        mimetype='application/xml')
+
 def media_file(filename):
-    return send_from_directory(app.config['MEDIA_CACHE_FOLDER'], filename)
-
-app.wsgi_app = ProxyFix(app.wsgi_app)
-
-if not app.debug:
-    mail_handler = SMTPHandler(mailhost=app.config.get('MAIL_SERVER'),
-                            fromaddr=app.config.get('DEFAULT_MAIL_SENDER'),
-                            toaddrs=app.config.get('ADMINS'),
-                            subject='Flask %s Failed' % app.config.get('TITLE'),
-                            credentials=app.config.get('MAIL_CREDENTIALS', None),
-                            secure=app.config.get('MAIL_SECURE', None))
-    mail_handler.setLevel(logging.ERROR)
-    app.logger.addHandler(mail_handler)
+    '''Media cache: thumbnails
+
+    A replaced image keeps its thumbnail name, so thumbnails are sent with a
+    short MEDIA_CACHE_MAX_AGE and an ETag from name, size and time to be
+    revalidated. Conditional and Range requests are answered here, or by the web server when
+    MEDIA_SENDFILE is 'x-sendfile' or 'x-accel-redirect'.
+    '''
+    config = current_app.config
+    folder = config['MEDIA_CACHE_FOLDER']
+    filename = safe_join(folder, filename)
+    if not filename or not os.path.isfile(filename):
+        # evicted thumbnail: check the file again on next thumbnail filter
+        if filename:
+            current_app.thumbnails.index.delete(filename)
+        abort(404)
+    stat = os.stat(filename)
+
+    sendfile = config.get('MEDIA_SENDFILE')
+    if sendfile:
+        response = Response(mimetype=mimetypes.guess_type(filename)[0])
+        if sendfile == 'x-accel-redirect':
+            response.headers['X-Accel-Redirect'] = \
+                config['MEDIA_ACCEL_REDIRECT_URL'] + \
+                os.path.relpath(filename, folder)
+        else:
+            response.headers['X-Sendfile'] = filename
+    else:
+        response = send_file(filename, add_etags=False, conditional=False)
+
+    response.set_etag(hashlib.md5((u'%s-%s-%s' % (filename, stat.st_mtime,
+        stat.st_size)).encode('utf-8')).hexdigest())
+    response.last_modified = int(stat.st_mtime)
+    # thumbnail names do not change with the image: revalidate with the ETag
+    response.headers['Cache-Control'] = 'public, max-age=%s' % \
+        config.get('MEDIA_CACHE_MAX_AGE', 3600)
+    if sendfile:
+        return response
+    return response.make_conditional(request, accept_ranges=True,
+        complete_length=stat.st_size)
+
+def create_app(config=None, warmup=None):
+    '''Create Flask APP
+
+    Tryton is set up with the first app and shared by the next ones (same
+    TRYTON_DATABASE). Requests may be served by threads; Tryton
+    transactions are bounded by TRYTON_POOL_SIZE.
+
+    With warmup (default WARMUP config), the Tryton pool, templates and
+    CMS caches are loaded and database connections are closed, so workers
+    forked from this process share them (see prefork).
+    '''
+    cfg = get_config()
+    app_name = cfg['flask']['app_name']
+    app = Flask(app_name)
+    app.config.from_pyfile(config)
+    app.config['BABEL_DEFAULT_LOCALE'] = app.config.get('LANGUAGE')
+    app.root_path = path
+    timezone = app.config.get('TIMEZONE')
+    app.timezone = pytz.timezone(timezone) if timezone else None
+
+    babel = Babel(app)
+    babel.localeselector(get_locale)
+    app.cache = create_cache(app.config)
+    app.thumbnails = ThumbnailEngine(app.config.get('THUMBNAIL_PROCESSES'),
+        cache=app.cache,
+        index_size=app.config.get('THUMBNAIL_INDEX_SIZE', 100000),
+        max_pixels=app.config.get('THUMBNAIL_MAX_PIXELS'),
+        progressive=app.config.get('THUMBNAIL_PROGRESSIVE', False))
+
+    if app.config.get('DEBUG'):
+        app.wsgi_app = DebuggedApplication(app.wsgi_app, True)
+
+    app.transaction_pool = None
+    if app.config.get('TRYTON_POOL_SIZE'):
+        from lazy_transaction import TransactionPool
+        app.transaction_pool = TransactionPool(app.config['TRYTON_POOL_SIZE'],
+            app.config.get('TRYTON_POOL_TIMEOUT'))
+
+    # galatea modules set up Tryton for current_app on first import. The
+    # context is popped after: a context left pushed would be shared by
+    # every request of the thread, with its g.
+    ctx = app.app_context()
+    ctx.push()
+    from galatea.tryton import tryton
+    if 'Tryton' not in app.extensions:
+        share_tryton(app, tryton)
+    from lazy_transaction import LazyPool, lazy_transaction, \
+        bound_transactions
+    if not isinstance(tryton.pool, LazyPool):
+        tryton.pool = LazyPool(tryton.pool)
+    tryton.default_context(default_context)
+    # before the blueprints decorate their functions with
+    # tryton.transaction(): they hold a slot of the pool and are timed
+    bound_transactions(tryton)
+
+    from galatea.sessions import GalateaSessionInterface
+    from sessions import HybridSessionInterface
+    app.session_interface = HybridSessionInterface(GalateaSessionInterface(),
+        app.config.get('SESSION_COOKIE_MAX_SIZE', 2048),
+        app.config.get('SESSION_COOKIE_KEYS'))
+
+    # register Blueprints - modules
+    from galatea import galatea
+    app.register_blueprint(galatea, url_prefix='/<lang>')
+    from galatea_file import galatea_file
+    app.register_blueprint(galatea_file)
+
+    # context procesors and filters
+    import context_processors
+    import defaultfilters
+    context_processors.init_app(app)
+    defaultfilters.init_app(app)
+    from pagecache import cached_page, cache_page
+    from compression import compress_response
+    from metrics import init_metrics
+    ctx.pop()
+
+    app.before_request(func)
+    # full page cache: after func, it needs g.language
+    app.before_request(cached_page)
+    # after_request functions run in reverse order: compress_response runs
+    # after cache_page, which stores and sends compressed pages itself
+    app.after_request(compress_response)
+    app.after_request(cache_page)
+    # instrumentation: after before_request hooks
+    init_metrics(app)
+
+    app.register_error_handler(404, lazy_transaction(tryton)(page_not_found))
+    app.register_error_handler(500, server_error)
+
+    view = lazy_transaction(tryton)(index)
+    app.add_url_rule('/', 'index', view)
+    for lang in ('en', 'es', 'ca'):
+        app.add_url_rule('/%s/' % lang, lang, view)
+    app.add_url_rule('/sitemap.xml', 'sitemap', sitemap)
+    app.add_url_rule('/sitemap-<name>-<int:page>.xml', 'sitemap_page',
+        sitemap_page)
+    app.add_url_rule('/media/cache/<path:filename>', 'media_file',
+        media_file)
+
+    app.wsgi_app = ProxyFix(app.wsgi_app)
+
+    if not app.debug:
+        from errormail import init_error_mail
+        init_error_mail(app)
+
+    if warmup is None:
+        warmup = app.config.get('WARMUP', False)
+    if warmup:
+        from prefork import warmup as warmup_app
+        warmup_app(app)
+    return app
+
+conf_file = os.environ.get('GALATEA_CONFIG', '%s/config.cfg' % path)
+
+app = create_app(conf_file)
 
 if __name__ == "__main__":
     app.run()
@@ -0,0 +1,692 @@
+#This file is part galatea app for Flask.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+'''Benchmarks
+
+Run app.py routes and filters through the Flask test client against an
+in-memory Tryton stand-in (no database needed) and report latency
+percentiles, Tryton queries and transactions by request and memory:
+
+python benchmark.py
+python benchmark.py --scenario index --scenario menus --requests 500
+python benchmark.py --scenario sitemap --products 1000 --products 100000
+
+The stand-in replaces the trytond, galatea and galatea_file modules: it
+must be installed before app is imported. Models keep their records in
+lists, search results are kept by domain (like a database index) and each
+search_read/search_count call is counted as a query.
+
+Keep the output of a run (python benchmark.py > bench_output.txt) to
+compare it with the next one before a deploy.
+'''
+import argparse
+import gc
+import hashlib
+import itertools
+import math
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import types
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal
+from functools import wraps
+
+PATH = os.path.dirname(os.path.realpath(__file__))
+LANGUAGES = {'en': 'en_US', 'es': 'es_ES', 'ca': 'ca_ES'}
+
+
+class Cursor(object):
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class Transaction(object):
+    '''Stand-in of trytond.transaction.Transaction: counts transactions'''
+    count = 0
+    cursor = Cursor()
+
+    def start(self, database_name, user, readonly=False, context=None,
+            **kwargs):
+        Transaction.count += 1
+        self.context = context or {}
+        return self
+
+    def stop(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+
+class Field(object):
+
+    def __init__(self, type_):
+        self._type = type_
+
+
+class Cache(object):
+    '''Stand-in of trytond.cache.Cache'''
+
+    @staticmethod
+    def clean(database_name):
+        pass
+
+    @staticmethod
+    def resets(database_name):
+        pass
+
+
+class Model(object):
+    '''In-memory Tryton model'''
+
+    def __init__(self, name, database):
+        self.__name__ = name
+        self.database = database
+        self.clear()
+
+    def clear(self):
+        self.records = []
+        self._searches = {}
+
+    def create(self, vlist):
+        for values in vlist:
+            values['id'] = len(self.records) + 1
+            self.records.append(values)
+        self._searches = {}
+        return [v['id'] for v in vlist]
+
+    @property
+    def _fields(self):
+        '''Fields of the records created'''
+        return dict((name, Field('char')) for record in self.records
+            for name in record if name != 'id')
+
+    def _descendants(self, ids):
+        childs = defaultdict(list)
+        for record in self.records:
+            if record.get('parent'):
+                childs[record['parent']].append(record['id'])
+        result = set()
+        stack = list(ids)
+        while stack:
+            id_ = stack.pop()
+            if id_ not in result:
+                result.add(id_)
+                stack.extend(childs[id_])
+        return result
+
+    def _match(self, record, clause):
+        field, operator, value = clause
+        if operator == 'child_of':
+            return record['id'] in value
+        current = record.get(field)
+        if operator == '=':
+            return current == value
+        elif operator == '!=':
+            return current != value
+        elif operator in ('in', 'not in'):
+            if isinstance(current, list):
+                found = bool(set(current) & set(value))
+            else:
+                found = current in value
+            return found if operator == 'in' else not found
+        raise ValueError('Operator not supported: %s' % operator)
+
+    def _search(self, domain):
+        key = repr(domain)
+        records = self._searches.get(key)
+        if records is None:
+            clauses = []
+            for field, operator, value in domain:
+                if operator == 'child_of':
+                    value = self._descendants(value)
+                clauses.append((field, operator, value))
+            records = self._searches[key] = [r for r in self.records
+                if all(self._match(r, c) for c in clauses)]
+        return records
+
+    def search_read(self, domain, offset=0, limit=None, order=None,
+            fields_names=None):
+        self.database.calls[self.__name__] += 1
+        records = self._search(domain)
+        if order and order[0][1].upper() == 'DESC':
+            records = records[::-1]
+        records = records[offset:offset + limit if limit else None]
+        fields_names = fields_names or []
+        return [dict([('id', r['id'])] + [(f, r.get(f)) for f in fields_names])
+            for r in records]
+
+    def search_count(self, domain):
+        self.database.calls[self.__name__] += 1
+        return len(self._search(domain))
+
+
+class Database(object):
+    '''Models of the Tryton stand-in, used as tryton.pool'''
+    MODELS = ('galatea.cms.menu', 'galatea.cms.block', 'galatea.static.file',
+        'galatea.cms.carousel', 'galatea.cms.carousel.item',
+        'galatea.cms.article', 'esale.catalog.menu', 'product.template',
+        'ir.attachment')
+
+    def __init__(self):
+        self.calls = defaultdict(int)
+        self.models = dict((n, Model(n, self)) for n in self.MODELS)
+
+    def get(self, name, type='model'):
+        return self.models[name]
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+
+class Tryton(object):
+    '''Stand-in of the flask_tryton Tryton object'''
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.context_callback = None
+
+    def default_context(self, callback):
+        self.context_callback = callback
+        return callback
+
+    @staticmethod
+    def transaction(readonly=None, user=None, context=None):
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                from flask import current_app
+                tryton = current_app.extensions['Tryton']
+                context = tryton.context_callback() \
+                    if tryton.context_callback else {}
+                with Transaction().start('benchmark', 0, readonly=readonly,
+                        context=context):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+def install_stubs(data_path):
+    '''Install trytond, galatea and galatea_file stand-in modules. Return
+    the Database of the Tryton pool'''
+    from flask import Blueprint
+    from flask.sessions import SecureCookieSessionInterface
+
+    database = Database()
+    trytond = _module('trytond', __path__=[], __version__='3.8.0')
+    trytond.config = _module('trytond.config',
+        CONFIG={'data_path': data_path})
+    trytond.transaction = _module('trytond.transaction',
+        Transaction=Transaction)
+    trytond.cache = _module('trytond.cache', Cache=Cache)
+    trytond.exceptions = _module('trytond.exceptions',
+        UserError=type('UserError', (Exception,), {}),
+        UserWarning=type('UserWarning', (Exception,), {}),
+        ConcurrencyException=type('ConcurrencyException', (Exception,), {}))
+
+    galatea = _module('galatea', __path__=[],
+        galatea=Blueprint('galatea', __name__))
+    galatea.tryton = _module('galatea.tryton', tryton=Tryton(database))
+    galatea.sessions = _module('galatea.sessions',
+        GalateaSessionInterface=SecureCookieSessionInterface)
+    galatea.helpers = _module('galatea.helpers',
+        login_required=lambda func: func)
+    galatea.utils = _module('galatea.utils',
+        get_tryton_language=lambda lang: LANGUAGES.get(lang, lang),
+        get_tryton_locale=lambda lang: {'date': '%d/%m/%Y',
+            'thousands_sep': '.', 'decimal_point': ','})
+    _module('galatea_file', galatea_file=Blueprint('galatea_file', __name__))
+    return database
+
+def register_blueprints(app):
+    '''Register the cms and catalog endpoints used by sitemaps'''
+    from flask import Blueprint
+
+    view = lambda lang, slug: slug
+    cms = Blueprint('cms', __name__)
+    cms.add_url_rule('/article/<slug>', 'article', view)
+    app.register_blueprint(cms, url_prefix='/<lang>')
+    catalog = Blueprint('catalog', __name__)
+    for lang in LANGUAGES:
+        catalog.add_url_rule('/product-%s/<slug>' % lang, 'product_' + lang,
+            view)
+    app.register_blueprint(catalog, url_prefix='/<lang>/catalog')
+
+
+def slugs(prefix, i):
+    return dict((l, '%s-%s-%s' % (prefix, lang, i))
+        for lang, l in LANGUAGES.iteritems())
+
+def create_menu(Menu, code, depth, width, website=None):
+    '''Create a menu tree of width childs by menu, depth levels deep'''
+    root, = Menu.create([{'code': code, 'slug': code, 'name': code,
+        'parent': None, 'website': website}])
+    parents = [root]
+    for level in range(depth):
+        vlist = []
+        for parent in parents:
+            for i in range(width):
+                n = len(Menu.records) + len(vlist)
+                vlist.append({
+                        'code': None,
+                        'slug': '/en/%s-%s' % (code, n),
+                        'name': 'Menu %s' % n,
+                        'parent': parent,
+                        'website': website,
+                        'nofollow': False,
+                        'icon': None,
+                        'css': None,
+                        'login': n % 10 == 0,
+                        'manager': False,
+                        })
+        parents = Menu.create(vlist)
+
+def create_images(data_path, database, count, size=(2000, 1500)):
+    '''Create count JPEG images in the filestore. Return (digest, name)'''
+    from PIL import Image
+
+    gradient = Image.linear_gradient('L').resize(size)
+    images = []
+    for i in range(count):
+        digest = hashlib.md5('image-%s' % i).hexdigest()
+        folder = os.path.join(data_path, 'benchmark', digest[0:2],
+            digest[2:4])
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        noise = Image.effect_noise(size, 32 + i)
+        Image.merge('RGB', (gradient, noise, gradient.rotate(90 * i))).save(
+            os.path.join(folder, digest), 'JPEG', quality=90)
+        images.append((digest, 'image-%s.jpg' % i))
+    database.get('ir.attachment').create([{'digest': d, 'name': n}
+            for d, n in images])
+    return images
+
+def create_products(database, count, images):
+    Template = database.get('product.template')
+    Template.clear()
+    Template.create([{
+                'name': 'Product %s' % i,
+                'esale_active': i % 20 != 0,
+                'esale_saleshops': [1],
+                'esale_slug_langs': slugs('product', i),
+                'list_price': Decimal('%s.%02d' % (i % 500, i % 100)),
+                'create_date': datetime(2016, 1 + i % 12, 1 + i % 28),
+                'image_digest': images[i % len(images)][0] if images else None,
+                'image_name': images[i % len(images)][1] if images else None,
+                } for i in range(count)])
+
+def populate(database, products, images, menu_depth, menu_width):
+    '''Create the CMS records and products of the benchmarks'''
+    Menu = database.get('galatea.cms.menu')
+    create_menu(Menu, 'header', 2, 8)
+    create_menu(Menu, 'footer', 1, 10)
+    create_menu(Menu, 'deep', menu_depth, menu_width)
+    create_menu(database.get('esale.catalog.menu'), 'products', 3, 5,
+        website=1)
+
+    files = database.get('galatea.static.file').create([
+            {'url': '/static/banner-%s.jpg' % i} for i in range(12)])
+    database.get('galatea.cms.block').create([{
+                'code': 'banner%s' % i,
+                'type': ('image', 'remote_image', 'custom_code')[i % 3],
+                'file': files[i],
+                'remote_image_url': 'http://localhost/banner-%s.jpg' % i,
+                'click_url': '/en/banner-%s' % i,
+                'custom_code': '<div class="banner">Banner %s</div>' % i,
+                'height': 200,
+                'width': 400,
+                'alternative_text': 'Banner %s' % i,
+                } for i in range(12)])
+
+    carousel, = database.get('galatea.cms.carousel').create([
+            {'code': 'home', 'name': 'Home'}])
+    database.get('galatea.cms.carousel.item').create([{
+                'carousel': carousel,
+                'name': 'Slide %s' % i,
+                'link': '/en/slide-%s' % i,
+                'image': '/static/slide-%s.jpg' % i,
+                'sublink': None,
+                'description': 'Slide %s' % i,
+                } for i in range(10)])
+
+    database.get('galatea.cms.article').create([{
+                'active': True,
+                'galatea_website': 1,
+                'slug_langs': slugs('article', i),
+                } for i in range(200)])
+    create_products(database, products, images)
+
+
+INDEX_TEMPLATE = u'''\
+{{ cms_prefetch(menus=['header', 'footer'], blocks=blocks,
+    carousels=['home'], catalog_menus=['products']) }}
+{% macro render_menu(menus) %}<ul>{% for menu in menus %}
+<li><a href="{{ menu.slug }}">{{ menu.name }}</a>
+{% if menu.childs %}{{ render_menu(menu.childs) }}{% endif %}</li>
+{% endfor %}</ul>{% endmacro %}
+<!DOCTYPE html>
+<html><head><title>{{ config.TITLE }}</title></head>
+<body>
+{{ render_menu(cms_menu('header')) }}
+{% set carousel = cms_carousel('home') %}
+{% for item in carousel.items %}<a href="{{ item.link }}">
+<img src="{{ item.image }}" alt="{{ item.name }}"/></a>{% endfor %}
+{% for code in blocks %}{{ cms_block(code)|safe }}{% endfor %}
+{{ render_menu(catalog_menu('products')) }}
+{% for product in featured_products() %}
+<div class="product"><img src="{{ product.image_digest|thumbnail(
+    product.image_name, '200x200', 'fit') }}"/>
+<h2>{{ product.name }}</h2>{{ product.list_price|price|safe }}
+{{ product.create_date|dateformat }}</div>
+{% endfor %}
+{{ text|wikimarkup|safe }}
+{{ render_menu(cms_menu('footer')) }}
+</body></html>
+'''
+
+MENU_TEMPLATE = u'''\
+{% macro render_menu(menus) %}<ul>{% for menu in menus %}
+<li><a href="{{ menu.slug }}">{{ menu.name }}</a>
+{% if menu.childs %}{{ render_menu(menu.childs) }}{% endif %}</li>
+{% endfor %}</ul>{% endmacro %}
+{{ render_menu(cms_menu('deep')) }}
+'''
+
+WIKI_TEXT = u"""\
+== Welcome ==
+
+Our '''shop''' sells [[products]] of all kinds.
+
+* Fast delivery
+* Secure payment
+"""
+
+
+def rss():
+    '''Return (current, peak) resident memory in MB'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    try:
+        with open('/proc/self/statm') as f:
+            current = int(f.read().split()[1]) * \
+                resource.getpagesize() / 1048576.
+    except IOError:
+        current = peak
+    return current, peak
+
+def percentile(samples, p):
+    '''Return p percentile of sorted samples (nearest rank)'''
+    index = int(math.ceil(p / 100. * len(samples))) - 1
+    return samples[min(max(index, 0), len(samples) - 1)]
+
+
+class Benchmark(object):
+
+    def __init__(self, app, database, output=sys.stdout):
+        self.app = app
+        self.database = database
+        self.output = output
+        self.client = app.test_client()
+
+    def header(self):
+        print >> self.output, '%-28s %6s %9s %9s %9s %9s %8s %6s %8s %8s' % (
+            'scenario', 'n', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms',
+            'queries', 'tx', 'rss MB', 'peak MB')
+
+    def run(self, name, count, func, setup=None):
+        '''Run func count times, setup (not timed) before each run, and
+        report latencies, queries and transactions by run and memory'''
+        gc.collect()
+        calls = self.database.total_calls()
+        transactions = Transaction.count
+        samples = []
+        for _ in range(count):
+            if setup:
+                setup()
+            start = time.time()
+            func()
+            samples.append((time.time() - start) * 1000)
+        samples.sort()
+        queries = self.database.total_calls() - calls
+        transactions = Transaction.count - transactions
+        current, peak = rss()
+        print >> self.output, '%-28s %6s %9.2f %9.2f %9.2f %9.2f %8.1f ' \
+            '%6.1f %8.1f %8.1f' % (name, count, percentile(samples, 50),
+                percentile(samples, 90), percentile(samples, 99),
+                samples[-1], queries / float(count),
+                transactions / float(count), current, peak)
+        self.output.flush()
+
+    def get(self, path, headers=None, status=(200, 304)):
+        def func():
+            response = self.client.get(path, headers=headers)
+            response.get_data()
+            assert response.status_code in status, \
+                '%s: %s' % (path, response.status_code)
+        return func
+
+    def request_context(self, path='/'):
+        '''Return a request context with before_request hooks run'''
+        ctx = self.app.test_request_context(path,
+            base_url=self.app.config.get('BASE_URL'))
+        ctx.push()
+        self.app.preprocess_request()
+        return ctx
+
+    def clear_cache(self):
+        self.app.cache.clear()
+
+    def index(self, count):
+        '''Home page: CMS menus, blocks, carousel, products, filters'''
+        config = self.app.config
+        headers = {'Accept-Encoding': 'gzip'}
+        # first request creates the thumbnails
+        self.get('/')()
+        self.run('index-cold', count, self.get('/', headers),
+            setup=self.clear_cache)
+        self.run('index-warm', count, self.get('/', headers))
+        config['PAGE_CACHE'] = True
+        try:
+            self.get('/', headers)()
+            self.run('index-page-cache', count, self.get('/', headers))
+        finally:
+            config['PAGE_CACHE'] = False
+        self.run('not-found', count, self.get('/en/missing/', headers,
+                status=(404,)))
+
+    def menus(self, count):
+        '''Deep menu tree rendered with cms_menu'''
+        from flask import render_template_string
+        from galatea.tryton import tryton
+        from lazy_transaction import lazy_transaction
+
+        @lazy_transaction(tryton)
+        def render():
+            return render_template_string(MENU_TEMPLATE)
+
+        def func():
+            ctx = self.request_context()
+            try:
+                render()
+            finally:
+                ctx.pop()
+
+        self.run('menus-deep-cold', count, func, setup=self.clear_cache)
+        self.run('menus-deep-warm', count, func)
+
+    def sitemap(self, count, products, images):
+        '''Sitemap build, precomputed files and streamed pages'''
+        from sitemap import refresh_sitemaps, sitemap_xml
+
+        for total in products:
+            label = '%sk' % (total // 1000) if total >= 1000 else str(total)
+            create_products(self.database, total, images)
+            self.clear_cache()
+            folder = tempfile.mkdtemp(prefix='sitemap-',
+                dir=self.app.config['MEDIA_FOLDER'])
+            self.app.config['SITEMAP_FOLDER'] = folder
+
+            self.run('sitemap-build-%s' % label, 1,
+                lambda: refresh_sitemaps(self.app, folder))
+            self.run('sitemap-index-%s' % label, count,
+                self.get('/sitemap.xml', {'Accept-Encoding': 'gzip'}))
+            self.run('sitemap-page-%s' % label, min(count, 20),
+                self.get('/sitemap-products-1.xml',
+                    {'Accept-Encoding': 'gzip'}))
+
+            def stream():
+                ctx = self.request_context()
+                try:
+                    for _ in sitemap_xml('products', 1):
+                        pass
+                finally:
+                    ctx.pop()
+            self.run('sitemap-stream-%s' % label, min(count, 3), stream)
+            shutil.rmtree(folder)
+
+    def thumbnail(self, image, size, crop=None):
+        from defaultfilters import thumbnail
+
+        digest, name = image
+        ctx = self.request_context()
+        try:
+            return thumbnail(digest, name, size, crop)
+        finally:
+            ctx.pop()
+
+    def thumbnails(self, count, images):
+        '''Thumbnail generation over the images corpus and serving'''
+        engine = self.app.thumbnails
+        urls = []
+        for size, crop in (('200x200', 'fit'), ('800x800', None)):
+            shutil.rmtree(self.app.config['MEDIA_CACHE_FOLDER'],
+                ignore_errors=True)
+            engine.index.clear()
+            engine._failed.clear()
+            corpus = iter(images)
+            self.run('thumbnail-generate-%s' % size, len(images),
+                lambda: urls.append(self.thumbnail(next(corpus), size, crop)))
+        corpus = itertools.cycle(images)
+        self.run('thumbnail-hit', count,
+            lambda: self.thumbnail(next(corpus), '800x800'))
+        self.run('media-file', count, self.get(urls[-1]))
+
+
+def write_config(folder, data_path):
+    '''Write config.cfg (the template with benchmark values) and config.ini
+    to folder. Return their paths'''
+    cfg = os.path.join(folder, 'config.cfg')
+    ini = os.path.join(folder, 'config.ini')
+    media = os.path.join(folder, 'media')
+    with open(os.path.join(PATH, 'config.cfg.template')) as f:
+        template = f.read()
+    with open(cfg, 'w') as f:
+        f.write(template)
+        f.write('\n# benchmark\n')
+        for key, value in (
+                ('DEBUG', False),
+                ('CACHE_TYPE', 'simple'),
+                ('CACHE_THRESHOLD', 100000),
+                ('CACHE_LOCAL_SIZE', None),
+                ('METRICS', False),
+                ('PAGE_CACHE', False),
+                ('MEDIA_FOLDER', media),
+                ('MEDIA_CACHE_FOLDER', os.path.join(media, 'cache')),
+                ('SITEMAP_FOLDER', os.path.join(media, 'sitemap')),
+                ('THUMBNAIL_PROCESSES', 0),
+                ('THUMBNAIL_FORMAT', None),
+                ('TRYTON_DATABASE', 'benchmark'),
+                ('ADMINS', ()),
+                ):
+            f.write('%s = %r\n' % (key, value))
+    shutil.copy(os.path.join(PATH, 'config.ini.template'), ini)
+    os.makedirs(media)
+    return cfg, ini
+
+def main():
+    parser = argparse.ArgumentParser(description='Galatea app benchmarks')
+    parser.add_argument('--scenario', action='append',
+        choices=['index', 'menus', 'sitemap', 'thumbnails'],
+        help='Scenarios to run (default all)')
+    parser.add_argument('--requests', type=int, default=200,
+        help='Requests by scenario')
+    parser.add_argument('--products', type=int, action='append',
+        help='Products of sitemap scenarios (default 1000 and 100000)')
+    parser.add_argument('--images', type=int, default=20,
+        help='Images of the thumbnails corpus (at least 1)')
+    parser.add_argument('--menu-depth', type=int, default=5)
+    parser.add_argument('--menu-width', type=int, default=4)
+    args = parser.parse_args()
+    if args.images < 1:
+        parser.error('--images must be at least 1')
+    scenarios = args.scenario or ['index', 'menus', 'sitemap', 'thumbnails']
+    products = args.products or [1000, 100000]
+
+    folder = tempfile.mkdtemp(prefix='galatea-benchmark-')
+    try:
+        data_path = os.path.join(folder, 'data')
+        database = install_stubs(data_path)
+        os.environ['GALATEA_CONFIG'], os.environ['GALATEA_CONFIG_INI'] = \
+            write_config(folder, data_path)
+
+        from jinja2 import ChoiceLoader, DictLoader
+        from app import app
+        register_blueprints(app)
+        app.jinja_loader = ChoiceLoader([DictLoader({
+                        'index.html': INDEX_TEMPLATE,
+                        '404.html': u'Not found',
+                        '500.html': u'Error',
+                        }), app.jinja_loader])
+
+        @app.context_processor
+        def benchmark_processor():
+            from galatea.tryton import tryton
+
+            def featured_products():
+                Template = tryton.pool.get('product.template')
+                return Template.search_read([('esale_active', '=', True)],
+                    limit=20, fields_names=['name', 'list_price',
+                        'create_date', 'image_digest', 'image_name'])
+            return dict(blocks=['banner%s' % i for i in range(12)],
+                featured_products=featured_products, text=WIKI_TEXT)
+
+        images = create_images(data_path, database, args.images)
+        populate(database, min(products), images, args.menu_depth,
+            args.menu_width)
+
+        benchmark = Benchmark(app, database)
+        print 'Python %s, %s requests by scenario, %s menus, %s images' % (
+            sys.version.split()[0], args.requests,
+            len(database.get('galatea.cms.menu').records), len(images))
+        benchmark.header()
+        if 'index' in scenarios:
+            benchmark.index(args.requests)
+        if 'menus' in scenarios:
+            benchmark.menus(args.requests)
+        if 'thumbnails' in scenarios:
+            benchmark.thumbnails(args.requests, images)
+        if 'sitemap' in scenarios:
+            benchmark.sitemap(args.requests, products, images)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
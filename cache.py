@@ -0,0 +1,395 @@
+#This file is part galatea app for Flask.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+import hashlib
+import math
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from flask import current_app, g
+from werkzeug.contrib.cache import BaseCache, NullCache, SimpleCache, \
+    FileSystemCache, MemcachedCache, RedisCache
+
+# seconds a cache lock is kept at most
+LOCK_TIMEOUT = 60
+# seconds to wait for a value another process is computing
+LOCK_WAIT = 5
+
+def cache_version(namespace):
+    '''Return current version of a cache namespace
+
+    Keys built with cache_key() embed this version, so bumping it with
+    invalidate() makes every cached value of the namespace unreachable.
+    '''
+    key = 'version-%s' % namespace
+    version = current_app.cache.get(key)
+    if version is None:
+        version = int(time.time())
+        current_app.cache.add(key, version, timeout=0)
+    return version
+
+def invalidate(namespace):
+    '''Invalidate all cached values of a namespace
+
+    The version is incremented with inc(), atomic on memcached and redis.
+    '''
+    cache_version(namespace)
+    current_app.cache.inc('version-%s' % namespace)
+
+def cache_key(namespace, *args):
+    '''Return a versioned cache key for current website and language
+
+    cache_key('cms-menu', 'header') -> 'cms-menu-v1402000000-1-es-header'
+    '''
+    parts = [namespace, 'v%s' % cache_version(namespace),
+        current_app.config.get('TRYTON_GALATEA_SITE'),
+        getattr(g, 'language', None)]
+    parts.extend(args)
+    return u'-'.join(unicode(p) for p in parts).encode('utf-8')
+
+class CacheEntry(object):
+    '''Cached value with the time it becomes stale and the seconds it took
+    to compute'''
+
+    def __init__(self, value, expires, delta):
+        self.value = value
+        self.expires = expires
+        self.delta = delta
+
+
+def _lock_path(name):
+    folder = current_app.config['CACHE_DIR'].rstrip('/') + '.locks'
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            pass
+    return os.path.join(folder, hashlib.md5(name).hexdigest())
+
+def acquire_lock(name, timeout=LOCK_TIMEOUT):
+    '''Try to take a lock shared by all processes using the cache. Return
+    True if taken. Locks are released after timeout seconds.
+
+    The filesystem cache uses files created atomically (O_EXCL) and other
+    caches use add().
+    '''
+    cache = getattr(current_app.cache, 'backend', current_app.cache)
+    if isinstance(cache, FileSystemCache):
+        path = _lock_path(name)
+        try:
+            if time.time() - os.path.getmtime(path) > timeout:
+                os.remove(path)
+        except OSError:
+            pass
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except OSError:
+            return False
+        return True
+    return bool(cache.add('lock-%s' % name, 1, timeout=timeout))
+
+def release_lock(name):
+    '''Release lock taken with acquire_lock()'''
+    cache = getattr(current_app.cache, 'backend', current_app.cache)
+    if isinstance(cache, FileSystemCache):
+        try:
+            os.remove(_lock_path(name))
+        except OSError:
+            pass
+    else:
+        cache.delete('lock-%s' % name)
+
+def get_or_set(key, func, timeout=None, stale_timeout=None, beta=1.0):
+    '''Return cached value of key or compute it with func and cache it
+
+    func must not return None: use an empty value for "not found" so
+    misses are cached too.
+
+    The value is fresh for timeout seconds and it is kept stale_timeout
+    more seconds (default timeout). Only one process computes an expired
+    value, under a lock, while the others get the stale value. A fresh
+    value may also be computed a bit before it expires, with a probability
+    that grows with the time func takes and beta (0 to disable).
+    '''
+    cache = current_app.cache
+    if timeout is None:
+        timeout = cache.default_timeout
+    if stale_timeout is None:
+        stale_timeout = timeout
+
+    entry = cache.get(key)
+    if not isinstance(entry, CacheEntry):
+        entry = None
+    elif entry.expires is None or (time.time()
+            - entry.delta * beta * math.log(1 - random.random())
+            < entry.expires):
+        return entry.value
+
+    locked = acquire_lock(key)
+    if not locked:
+        if entry:
+            return entry.value
+        # wait for the process computing the value
+        waited = 0
+        while waited < LOCK_WAIT:
+            time.sleep(0.05)
+            waited += 0.05
+            entry = cache.get(key)
+            if isinstance(entry, CacheEntry):
+                return entry.value
+    try:
+        start = time.time()
+        value = func()
+        end = time.time()
+        cache.set(key, CacheEntry(value, end + timeout if timeout else None,
+                end - start),
+            timeout=timeout + stale_timeout if timeout else 0)
+    finally:
+        if locked:
+            release_lock(key)
+    return value
+
+def get_many_or_set(keys, func, timeout=None, stale_timeout=None):
+    '''Return dict of cached values by key. Missing values, and expired
+    ones not locked by another process, are computed at once with
+    func(keys) that must return a dict of values by key.
+
+    Values are stored like get_or_set() does, so both can share keys.
+    '''
+    cache = current_app.cache
+    if timeout is None:
+        timeout = cache.default_timeout
+    if stale_timeout is None:
+        stale_timeout = timeout
+
+    values = {}
+    missing = []
+    locked = []
+    now = time.time()
+    for key, entry in zip(keys, cache.get_many(*keys)):
+        if not isinstance(entry, CacheEntry):
+            missing.append(key)
+            continue
+        if entry.expires is not None and entry.expires < now:
+            if acquire_lock(key):
+                locked.append(key)
+                missing.append(key)
+                continue
+        values[key] = entry.value
+    if not missing:
+        return values
+
+    try:
+        start = time.time()
+        computed = func(missing)
+        end = time.time()
+        expires = end + timeout if timeout else None
+        cache.set_many(dict((k, CacheEntry(v, expires, end - start))
+                for k, v in computed.iteritems()),
+            timeout=timeout + stale_timeout if timeout else 0)
+    finally:
+        for key in locked:
+            release_lock(key)
+    values.update(computed)
+    return values
+
+def cached(timeout=None, key=None, stale_timeout=None, beta=1.0):
+    '''Decorator: cache result of a function by key (default function name)
+    and its arguments, for current website and language, with get_or_set()
+
+    @cached(3500, 'sitemap')
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            k = cache_key(key or func.__name__,
+                *(list(args) + [kwargs[n] for n in sorted(kwargs)]))
+            return get_or_set(k, lambda: func(*args, **kwargs), timeout,
+                stale_timeout, beta)
+        return wrapper
+    return decorator
+
+
+class LRUCache(object):
+    '''Bounded in-process mapping that drops least recently used keys
+
+    It is bounded by number of keys (maxsize) and, when maxbytes is set,
+    by the sum of the sizes given to set().
+    '''
+
+    def __init__(self, maxsize=1024, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value, size
+            return value
+
+    def set(self, key, value, size=0):
+        with self._lock:
+            if key in self._data:
+                self.size -= self._data.pop(key)[1]
+            self._data[key] = value, size
+            self.size += size
+            while len(self._data) > self.maxsize or (
+                    self.maxbytes and self.size > self.maxbytes):
+                self.size -= self._data.popitem(last=False)[1][1]
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                self.size -= self._data.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+
+class TieredCache(BaseCache):
+    '''Cache with an in-process LRU tier in front of a shared cache
+
+    Values are kept pickled in the local tier for at most local_timeout
+    seconds, so changes made by other processes (like invalidate()) are
+    seen after that time.
+    '''
+
+    def __init__(self, backend, maxsize=1000, maxbytes=None,
+            local_timeout=60):
+        super(TieredCache, self).__init__(backend.default_timeout)
+        self.backend = backend
+        self.local = LRUCache(maxsize, maxbytes)
+        self.local_timeout = local_timeout
+
+    def _local_get(self, key):
+        item = self.local.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if expires < time.time():
+            self.local.delete(key)
+            return None
+        return pickle.loads(value)
+
+    def _local_set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        if timeout:
+            timeout = min(timeout, self.local_timeout)
+        else:
+            timeout = self.local_timeout
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self.local.set(key, (time.time() + timeout, value), len(value))
+
+    def get(self, key):
+        value = self._local_get(key)
+        if value is None:
+            value = self.backend.get(key)
+            if value is not None:
+                self._local_set(key, value)
+        return value
+
+    def get_many(self, *keys):
+        values = [self._local_get(k) for k in keys]
+        missing = [k for k, v in zip(keys, values) if v is None]
+        if missing:
+            found = dict(zip(missing, self.backend.get_many(*missing)))
+            for i, key in enumerate(keys):
+                if values[i] is None and found.get(key) is not None:
+                    values[i] = found[key]
+                    self._local_set(key, values[i])
+        return values
+
+    def set(self, key, value, timeout=None):
+        self._local_set(key, value, timeout)
+        return self.backend.set(key, value, timeout)
+
+    def set_many(self, mapping, timeout=None):
+        for key, value in mapping.iteritems():
+            self._local_set(key, value, timeout)
+        return self.backend.set_many(mapping, timeout)
+
+    def add(self, key, value, timeout=None):
+        self.local.delete(key)
+        return self.backend.add(key, value, timeout)
+
+    def delete(self, key):
+        self.local.delete(key)
+        return self.backend.delete(key)
+
+    def delete_many(self, *keys):
+        for key in keys:
+            self.local.delete(key)
+        return self.backend.delete_many(*keys)
+
+    def has(self, key):
+        return self._local_get(key) is not None or self.backend.has(key)
+
+    def clear(self):
+        self.local.clear()
+        return self.backend.clear()
+
+    def inc(self, key, delta=1):
+        self.local.delete(key)
+        return self.backend.inc(key, delta)
+
+    def dec(self, key, delta=1):
+        self.local.delete(key)
+        return self.backend.dec(key, delta)
+
+
+def create_cache(config):
+    '''Return cache from CACHE_TYPE config: null, simple (in process, also a
+    stand-in for shared caches in tests), filesystem, memcached or redis.
+
+    With CACHE_LOCAL_SIZE, an in-process LRU tier is added in front of it.
+    '''
+    cache_type = config.get('CACHE_TYPE') or 'filesystem'
+    timeout = config.get('CACHE_TIMEOUT', 300)
+    key_prefix = config.get('CACHE_KEY_PREFIX')
+
+    if cache_type == 'null':
+        return NullCache(timeout)
+    elif cache_type == 'simple':
+        cache = SimpleCache(config.get('CACHE_THRESHOLD', 500), timeout)
+    elif cache_type == 'filesystem':
+        cache = FileSystemCache(config['CACHE_DIR'],
+            config.get('CACHE_THRESHOLD', 500), timeout)
+    elif cache_type == 'memcached':
+        cache = MemcachedCache(config.get('CACHE_MEMCACHED_SERVERS'),
+            timeout, key_prefix)
+    elif cache_type == 'redis':
+        cache = RedisCache(config.get('CACHE_REDIS_HOST', 'localhost'),
+            config.get('CACHE_REDIS_PORT', 6379),
+            config.get('CACHE_REDIS_PASSWORD'),
+            config.get('CACHE_REDIS_DB', 0), timeout, key_prefix)
+    else:
+        raise ValueError('Unknown CACHE_TYPE: %s' % cache_type)
+
+    if config.get('CACHE_LOCAL_SIZE'):
+        cache = TieredCache(cache, config['CACHE_LOCAL_SIZE'],
+            config.get('CACHE_LOCAL_MAX_BYTES'),
+            config.get('CACHE_LOCAL_TIMEOUT', 60))
+    return cache
@@ -0,0 +1,124 @@
+#This file is part galatea app for Flask.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+'''Response minification and compression
+
+With MINIFY, cached pages and sitemap files are stored minified. Other
+HTML and XML responses are only minified with MINIFY_RESPONSES: htmlmin is
+pure Python and pages with per request content (like form tokens) never
+hit the cache of minified output (kept by content hash). With COMPRESS,
+responses of COMPRESS_MIMETYPES bigger than COMPRESS_MIN_SIZE are
+compressed with brotli (when the brotli module is installed) or gzip, as
+accepted by the browser.
+
+Cached pages and sitemap files store their compressed variants, so they
+are compressed once by content version.
+'''
+import gzip
+import hashlib
+import re
+from cStringIO import StringIO
+
+import htmlmin
+from flask import current_app, request
+from cache import LRUCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# encodings by preference
+ENCODINGS = ('br', 'gzip')
+# file suffix of the stored variant of an encoding
+SUFFIXES = {
+    'br': '.br',
+    'gzip': '.gz',
+    }
+HTML_MIMETYPES = ('text/html',)
+XML_MIMETYPES = ('application/xml', 'text/xml')
+COMPRESS_MIMETYPES = HTML_MIMETYPES + XML_MIMETYPES + ('text/plain',
+    'text/css', 'application/javascript', 'application/json')
+# compression levels of responses and of stored variants
+GZIP_LEVEL = 6
+GZIP_BEST_LEVEL = 9
+BROTLI_QUALITY = 5
+BROTLI_BEST_QUALITY = 11
+
+_XML_SPACE = re.compile(r'>\s+<')
+_minified = LRUCache(1000, 10485760)
+
+
+def gzip_compress(data, level=GZIP_LEVEL):
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level,
+            mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+def gunzip(data):
+    with gzip.GzipFile(fileobj=StringIO(data), mode='rb') as f:
+        return f.read()
+
+def encodings():
+    '''Return available encodings by preference'''
+    return [e for e in ENCODINGS if e != 'br' or brotli]
+
+def compress(data, encoding, best=False):
+    '''Return data compressed with encoding ('br' or 'gzip'). With best,
+    the highest (slowest) level is used, for stored variants'''
+    if encoding == 'br':
+        return brotli.compress(data,
+            quality=BROTLI_BEST_QUALITY if best else BROTLI_QUALITY)
+    return gzip_compress(data, GZIP_BEST_LEVEL if best else GZIP_LEVEL)
+
+def accepted_encoding(available=None):
+    '''Return preferred encoding of available (default all) accepted by the
+    browser or None'''
+    if available is None:
+        available = encodings()
+    for encoding in ENCODINGS:
+        if encoding in available and request.accept_encodings[encoding] > 0:
+            return encoding
+    return None
+
+def minify(data, mimetype):
+    '''Return minified data (utf-8 str) of an HTML or XML mimetype'''
+    if mimetype in XML_MIMETYPES:
+        return _XML_SPACE.sub('><', data).strip()
+    if mimetype not in HTML_MIMETYPES:
+        return data
+    key = hashlib.md5(data).hexdigest()
+    value = _minified.get(key)
+    if value is None:
+        value = htmlmin.minify(data.decode('utf-8'),
+            remove_comments=True).encode('utf-8')
+        _minified.set(key, value, len(value))
+    return value
+
+def encode_response(response, data, encoding):
+    '''Set data compressed with encoding (or None) as body of response'''
+    response.set_data(data)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+def compress_response(response):
+    '''after_request hook: minify and compress response'''
+    config = current_app.config
+    if (response.status_code != 200
+            or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    data = response.get_data()
+    if config.get('MINIFY_RESPONSES'):
+        data = minify(data, response.mimetype)
+    encoding = None
+    if config.get('COMPRESS') and \
+            len(data) >= config.get('COMPRESS_MIN_SIZE', 500):
+        encoding = accepted_encoding()
+    if encoding:
+        data = compress(data, encoding)
+    return encode_response(response, data, encoding)
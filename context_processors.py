@@ -1,10 +1,250 @@
 #This file is part galatea app for Flask.
 #The COPYRIGHT file at the top level of this repository contains
 #the full copyright notices and license terms.
-from flask import current_app, session
+from flask import current_app, session, g
 from galatea.tryton import tryton
+from cache import cache_key, get_many_or_set
+from metrics import timed
+
+MENU_FIELDS = ['name', 'slug', 'nofollow', 'icon', 'css', 'login', 'manager']
+CATALOG_MENU_FIELDS = ['name', 'slug']
+
+def menu_trees(Menu, field, values, domain, fields_names):
+    """
+    Return flat menu trees by value of field (code or slug): the root menu
+    and all its descendants indexed by parent. All trees are read with
+    two queries.
+
+    {'header': {'root': 1, 'nodes': {1: {...}, 2: {...}}, 'childs': {1: [2]}}}
+    """
+    trees = dict((v, {}) for v in values)
+    roots = {}
+    # first menu of each value (by model order) is the root
+    for menu in reversed(Menu.search_read(domain + [(field, 'in', values)],
+                fields_names=[field])):
+        roots[menu[field]] = menu['id']
+    if not roots:
+        return trees
+
+    nodes = {}
+    childs = {}
+    for menu in Menu.search_read([
+            ('parent', 'child_of', roots.values()),
+            ], fields_names=fields_names + ['parent']):
+        nodes[menu['id']] = menu
+        if menu['parent']:
+            childs.setdefault(menu['parent'], []).append(menu['id'])
+
+    for value, root in roots.iteritems():
+        tree = {
+            'root': root,
+            'nodes': {},
+            'childs': {},
+            }
+        stack = [root]
+        while stack:
+            menu_id = stack.pop()
+            tree['nodes'][menu_id] = nodes[menu_id]
+            if menu_id in childs:
+                tree['childs'][menu_id] = childs[menu_id]
+                stack.extend(childs[menu_id])
+        trees[value] = tree
+    return trees
+
+def menu_childs(tree, levels, fields_names, check=None):
+    """
+    Return childs of the root menu of a tree, levels deep, as nested dicts.
+    check is an optional function to skip menus (and their childs).
+    """
+    if not tree:
+        return []
+    nodes = tree['nodes']
+    childs = tree['childs']
+
+    def get_menus(menu_id, level):
+        if level >= levels:
+            return []
+        values = []
+        for child_id in childs.get(menu_id, []):
+            node = nodes[child_id]
+            if check and not check(node):
+                continue
+            menu = dict((f, node[f]) for f in fields_names)
+            menu['id'] = child_id
+            menu['childs'] = get_menus(child_id, level + 1)
+            values.append(menu)
+        return values
+
+    return get_menus(tree['root'], 0)
+
+BLOCK_FIELDS = ['code', 'type', 'click_url', 'file', 'remote_image_url',
+    'custom_code', 'height', 'width', 'alternative_text']
+
+def render_block(block):
+    """
+    Return the HTML content of a block read with BLOCK_FIELDS. Image blocks
+    must have the static file url in 'file'.
+    """
+    if block['type'] in ('image', 'remote_image'):
+        image = u'<img src="%(src)s" alt="%(alternative_text)s"' \
+                u' width="%(width)s" height="%(height)s"/>' % {
+                    'src': (block['file'] if block['type'] == 'image'
+                        else block['remote_image_url']),
+                    'alternative_text': block.get('alternative_text') or '',
+                    'width': block.get('width') or '',
+                    'height': block.get('height') or '',
+                    }
+        if block.get('click_url'):
+            image = u'<a href="%(click_url)s">%(image)s</a>' % {
+                    'click_url': block['click_url'],
+                    'image': image,
+                    }
+        return image
+
+    elif block['type'] == 'custom_code':
+        return block['custom_code'] or ''
+    return ''
+
+def read_blocks(codes):
+    """
+    Return the HTML content of blocks by code, read with one query (and one
+    more for the urls of image blocks).
+    """
+    StaticFile = tryton.pool.get('galatea.static.file')
+    Block = tryton.pool.get('galatea.cms.block')
+
+    blocks = Block.search_read([('code', 'in', codes)],
+        fields_names=BLOCK_FIELDS)
+    file_ids = list(set(b['file'] for b in blocks
+        if b['type'] == 'image' and b['file']))
+    urls = {}
+    if file_ids:
+        urls = dict((f['id'], f['url']) for f in StaticFile.search_read(
+            [('id', 'in', file_ids)], fields_names=['url']))
+
+    values = dict((c, '') for c in codes)
+    # first block of each code (by model order) wins
+    for block in reversed(blocks):
+        if block['type'] == 'image':
+            block['file'] = urls.get(block['file'], '')
+        values[block['code']] = render_block(block)
+    return values
+
+# field types not kept in Record objects
+RECORD_EXCLUDED_TYPES = ('one2many', 'many2many', 'binary')
+
+def record_fields(Model):
+    """
+    Return the names of the fields of Model kept in Record objects: every
+    field but x2many and binary ones, so templates get the same values
+    they read from Tryton records.
+    """
+    return ['rec_name'] + sorted(name
+        for name, field in Model._fields.iteritems()
+        if field._type not in RECORD_EXCLUDED_TYPES)
+
+class Record(object):
+    """
+    Plain values of a Tryton record with attribute access for templates.
+    Unlike records, it does not read from Tryton and it can be pickled.
+    """
+
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+    def __repr__(self):
+        return '<Record %s>' % self.__dict__.get('id')
+
+def read_carousels(codes):
+    """
+    Return carousels by code with their items as Record objects (False when
+    it does not exist), read with one query by model.
+    """
+    Carousel = tryton.pool.get('galatea.cms.carousel')
+    Item = tryton.pool.get('galatea.cms.carousel.item')
+
+    values = dict((c, False) for c in codes)
+    carousels = {}
+    # first carousel of each code (by model order) wins
+    for carousel in reversed(Carousel.search_read([('code', 'in', codes)],
+                fields_names=record_fields(Carousel))):
+        carousel['items'] = []
+        carousels[carousel['code']] = carousel
+    if not carousels:
+        return values
+
+    by_id = dict((c['id'], c) for c in carousels.itervalues())
+    for item in Item.search_read([
+            ('carousel', 'in', by_id.keys()),
+            ], fields_names=record_fields(Item)):
+        if item['carousel'] in by_id:
+            by_id[item['carousel']]['items'].append(Record(item))
+    for code, carousel in carousels.iteritems():
+        values[code] = Record(carousel)
+    return values
+
+def read_menus(codes):
+    return menu_trees(tryton.pool.get('galatea.cms.menu'), 'code', codes,
+        [], MENU_FIELDS)
+
+def read_catalog_menus(slugs):
+    website = current_app.config.get('TRYTON_GALATEA_SITE')
+    return menu_trees(tryton.pool.get('esale.catalog.menu'), 'slug', slugs,
+        [('website', '=', website)], CATALOG_MENU_FIELDS)
+
+# functions that read CMS data from Tryton by namespace
+READERS = {
+    'cms-menu': read_menus,
+    'cms-block': read_blocks,
+    'cms-carousel': read_carousels,
+    'catalog-menu': read_catalog_menus,
+    }
+
+def load(namespace, values):
+    """
+    Return CMS data of a namespace (READERS) by value: menu trees by code,
+    blocks HTML by code,...
+
+    Data is looked up in the request store, then in app.cache (one
+    get_many), and the missing values are read from Tryton at once.
+    """
+    if not hasattr(g, 'cms_store'):
+        g.cms_store = {}
+    store = g.cms_store.setdefault(namespace, {})
+
+    missing = [v for v in set(values) if v not in store]
+    if missing:
+        keys = dict((cache_key(namespace, v), v) for v in missing)
+
+        def read(cache_keys):
+            data = READERS[namespace]([keys[k] for k in cache_keys])
+            return dict((k, data[keys[k]]) for k in cache_keys)
+
+        for key, value in get_many_or_set(keys.keys(), read).iteritems():
+            store[keys[key]] = value
+    return dict((v, store[v]) for v in values)
+
+def prefetch_cms(menus=None, blocks=None, carousels=None,
+        catalog_menus=None):
+    """
+    Load CMS data of a page at once, a query by model on cache misses.
+    Next cms_menu(), cms_block(), cms_carousel() and catalog_menu() calls
+    are served from the request store.
+    """
+    for namespace, values in (
+            ('cms-menu', menus),
+            ('cms-block', blocks),
+            ('cms-carousel', carousels),
+            ('catalog-menu', catalog_menus),
+            ):
+        values = [v for v in values or [] if v]
+        if values:
+            load(namespace, values)
+
+def init_app(app):
+    '''Add the CMS context processor to app'''
+    app.context_processor(cms_processor)
 
-@current_app.context_processor
 def cms_processor():
 
     def menu(code=None, levels=9999):
@@ -23,43 +263,21 @@ def cms_processor():
         if not code:
             return []
 
-        Menu = tryton.pool.get('galatea.cms.menu')
-
         login = session.get('logged_in')
         manager = session.get('manager')
 
-        # Search by code
-        menus = Menu.search([
-            ('code', '=', code),
-            ], limit=1)
-        if not menus:
-            return []
-        menu, = menus
-
-        def get_menus(menu, levels, level=0):
-            childs = []
-            if level < levels:
-                level += 1
-                for m in menu.childs:
-                    if m.login and not login:
-                        continue
-                    if m.manager and not manager:
-                        continue
-                    childs.append(get_menus(m, levels, level))
-            return {
-                'id': menu.id,
-                'name': menu.name,
-                'slug': menu.slug,
-                'childs': childs,
-                'nofollow': menu.nofollow,
-                'icon': menu.icon,
-                'css': menu.css,
-                }
-
-        menu = get_menus(menu, levels)
-        return menu['childs']
-
-        return menu['childs']
+        def check(menu):
+            if menu['login'] and not login:
+                return False
+            if menu['manager'] and not manager:
+                return False
+            return True
+
+        # Tree is cached (read from Tryton on misses only); filter by login
+        # and manager for each request
+        tree = load('cms-menu', [code])[code]
+        return menu_childs(tree, levels,
+            ['name', 'slug', 'nofollow', 'icon', 'css'], check)
 
     def block(code=None):
         """
@@ -73,68 +291,20 @@ def cms_processor():
         """
         if not code:
             return ''
+        return load('cms-block', [code])[code]
 
-        StaticFile =tryton.pool.get('galatea.static.file')
-        Block = tryton.pool.get('galatea.cms.block')
+    def blocks(*codes):
+        """
+        Load several blocks in one query and return the HTML content by code.
+        Next cms_block() calls of these codes do not query again.
 
-        # Search by code
-        fields_names = ['type', 'click_url', 'file',
-            'remote_image_url', 'custom_code', 'height', 'width',
-            'alternative_text', 'click_url']
-        blocks = Block.search_read([('code', '=', code)], limit=1, fields_names=fields_names)
-        if not blocks:
-            return ''
-        block, = blocks
+        HTML usage in template:
 
-        if block['type'] == 'image':
-            file = StaticFile(block['file'])
-            block['file'] = file.url
-
-            if not block.get('alternative_text'):
-                block['alternative_text'] = ''
-            if not block.get('width'):
-                block['width'] = ''
-            if not block.get('height'):
-                block['height'] = ''
-
-            image = u'<img src="%(file)s" alt="%(alternative_text)s"' \
-                    u' width="%(width)s" height="%(height)s"/>' % {
-                        'file': block['file'],
-                        'alternative_text': block['alternative_text'],
-                        'width': block['width'],
-                        'height': block['height'],
-                        }
-            if block.get('click_url'):
-                image = u'<a href="%(click_url)s">%(image)s</a>' % {
-                        'click_url': block['click_url'],
-                        'image': image,
-                        }
-            return image
-
-        elif block['type'] == 'remote_image':
-            if not block.get('alternative_text'):
-                block['alternative_text'] = ''
-            if not block.get('width'):
-                block['width'] = ''
-            if not block.get('height'):
-                block['height'] = ''
-
-            image = u'<img src="%(remote_image_url)s" alt="%(alternative_text)s"' \
-                    u' width="%(width)s" height="%(height)s"/>' % {
-                        'remote_image_url': block['remote_image_url'],
-                        'alternative_text': block['alternative_text'],
-                        'width': block['width'],
-                        'height': block['height'],
-                        }
-            if block.get('click_url'):
-                image = u'<a href="%(click_url)s">%(image)s</a>' % {
-                        'click_url': block['click_url'],
-                        'image': image,
-                        }
-            return image
-
-        elif block['type'] == 'custom_code':
-            return block['custom_code']
+        {% set blocks=cms_blocks('banner1', 'banner2') %}
+        {{ blocks.banner1|safe }}
+        {{ cms_block('banner2')|safe }}
+        """
+        return load('cms-block', [c for c in codes if c])
 
     def carousel(code=None):
         """
@@ -148,14 +318,8 @@ def cms_processor():
         if not code:
             return None
 
-        Carousel = tryton.pool.get('galatea.cms.carousel')
-
-        # Search by code
-        carousels = Carousel.search([('code', '=', code)])
-        if not carousels:
-            return None
-        carousel, = carousels
-        return carousel
+        # False is cached when the carousel does not exist
+        return load('cms-carousel', [code])[code] or None
 
     def catalog_menu(slug=None, levels=9999):
         """
@@ -173,36 +337,27 @@ def cms_processor():
         if not slug:
             return []
 
-        Menu = tryton.pool.get('esale.catalog.menu')
+        tree = load('catalog-menu', [slug])[slug]
+        return menu_childs(tree, levels, CATALOG_MENU_FIELDS)
 
-        # Search by code
-        menus = Menu.search([
-            ('slug', '=', slug),
-            ('website', '=', GALATEA_WEBSITE),
-            ], limit=1)
-        if not menus:
-            return []
-        menu, = menus
-
-        def get_menus(menu, levels, level=0):
-            childs = []
-            if level < levels:
-                level += 1
-                for m in menu.childs:
-                    childs.append(get_menus(m, levels, level))
-            return {
-                'id': menu.id,
-                'name': menu.name,
-                'slug': menu.slug,
-                'childs': childs,
-                }
-
-        menu = get_menus(menu, levels)
-        return menu['childs']
+    def cms_prefetch(menus=None, blocks=None, carousels=None,
+            catalog_menus=None):
+        """
+        Load CMS data of the page at once, before it is rendered
+
+        HTML usage in template (at the top of the base template):
+
+        {{ cms_prefetch(menus=['header', 'footer'], blocks=['banner1'],
+            carousels=['home'], catalog_menus=['products']) }}
+        """
+        prefetch_cms(menus, blocks, carousels, catalog_menus)
+        return ''
 
     return dict(
-        cms_menu=menu,
-        cms_block=block,
-        cms_carousel=carousel,
-        catalog_menu=catalog_menu,
+        cms_prefetch=timed('cms_prefetch')(cms_prefetch),
+        cms_menu=timed('cms_menu')(menu),
+        cms_block=timed('cms_block')(block),
+        cms_blocks=timed('cms_blocks')(blocks),
+        cms_carousel=timed('cms_carousel')(carousel),
+        catalog_menu=timed('catalog_menu')(catalog_menu),
         )
@@ -1,23 +1,35 @@
 #This file is part galatea app for Flask.
 #The COPYRIGHT file at the top level of this repository contains
 #the full copyright notices and license terms.
-from flask import current_app
+from flask import current_app, request, g
 from flask_babel import format_datetime, format_date, gettext as _
 from jinja2 import evalcontextfilter, Markup, escape, Template, filters
-from trytond.config import CONFIG as tryton_config
 from wikimarkup import parse as wikiparse
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
+from thumbnails import thumbnail_paths, output_format
+from cache import LRUCache
+from formatters import formatter
+from metrics import timed
 
+import hashlib
 import re
-import os
-try:
-    from PIL import Image, ImageOps
-except ImportError:
-    raise RuntimeError('Image module of PIL needs to be installed')
 
 _paragraph_re = re.compile(r'(?:\r\n|\r|\n){2,}')
+_UNIT = Decimal(1)
+# filters added to apps by init_app()
+_filters = []
 
-@current_app.template_filter()
+def template_filter(func):
+    '''Decorator: add func to the template filters of init_app()'''
+    _filters.append(func)
+    return func
+
+def init_app(app):
+    '''Add the template filters to app'''
+    for func in _filters:
+        app.add_template_filter(func)
+
+@template_filter
 @evalcontextfilter
 def nl2br(eval_ctx, value):
     result = u'\n\n'.join(u'<p>%s</p>' % p.replace('\n', Markup('<br/>\n')) \
@@ -26,8 +38,10 @@ def nl2br(eval_ctx, value):
         result = Markup(result)
     return result
 
-@current_app.template_filter()
-def thumbnail(filename, thumbname, size, crop=None, bg=None, quality=85):
+@template_filter
+@timed('thumbnail')
+def thumbnail(filename, thumbname, size, crop=None, bg=None, quality=85,
+        format=None):
     '''Create thumbnail image
 
     :param filename: image digest - '2566a0e6538be8e094431ff46ae58950'
@@ -36,72 +50,44 @@ def thumbnail(filename, thumbname, size, crop=None, bg=None, quality=85):
     :param crop: crop return thumb - 'fit' or None
     :param bg: tuple color or None - (255, 255, 255, 0)
     :param quality: JPEG quality 1-100
-    :return: :thumb_url:
+    :param format: 'jpeg', 'png', 'webp', 'avif', 'auto' (AVIF or WebP if
+        the browser accepts it) or None (THUMBNAIL_FORMAT or original)
+    :return: :thumb_url: or THUMBNAIL_PENDING_URL while it is generated
     '''
-
-    def _bg_square(img, color=0xff):
-        size = (max(img.size),) * 2
-        layer = Image.new('L', size, color)
-        layer.paste(img, tuple(map(lambda x: (x[0] - x[1]) / 2, zip(size, img.size))))
-        return layer
-
-    def _get_name(name, fm, *args):
-        for v in args:
-            if v:
-                name += '_%s' % v
-        name += fm
-        return name
-
     width, height = [int(x) for x in size.split('x')]
-    name, fm = os.path.splitext(thumbname)
-
-    miniature = _get_name(name, fm, size, crop, bg, quality)
-    
-    original_filename = os.path.join(tryton_config['data_path'], current_app.config['TRYTON_DATABASE'], filename[0:2], filename[2:4], filename)
-    thumb_filename = os.path.join(current_app.config['MEDIA_CACHE_FOLDER'], miniature)
-
-    thumb_url = os.path.join(current_app.config['MEDIA_CACHE_URL'], miniature)
-
-    if os.path.exists(thumb_filename):
+    fmt = output_format(format or current_app.config.get('THUMBNAIL_FORMAT'),
+        [m for m, q in request.accept_mimetypes] if request else None)
+    original_filename, thumb_filename, thumb_url = thumbnail_paths(
+        current_app.config, filename, thumbname, size, crop, bg, quality, fmt)
+
+    state = current_app.thumbnails.thumbnail(original_filename,
+        thumb_filename, width, height, crop, bg, quality, fmt)
+    if state == 'done':
         return thumb_url
-    else:
-        thumb_size = (width, height)
-
-        try:
-            image = Image.open(original_filename)  
-        except IOError:
-            return current_app.config['BASE_IMAGE']
-
-        if crop == 'fit':
-            img = ImageOps.fit(image, thumb_size, Image.ANTIALIAS)
-        else:
-            img = image.copy()
-            img.thumbnail((width, height), Image.ANTIALIAS)
-
-        if bg:
-            img = _bg_square(img, bg)
-
-        img.save(thumb_filename, image.format, quality=quality)
-
-        return thumb_url
-
-@current_app.template_filter()
+    elif state == 'pending':
+        # do not keep pages with pending thumbnails in full page cache
+        g.thumbnail_pending = True
+        return current_app.config.get('THUMBNAIL_PENDING_URL') or \
+            current_app.config['BASE_IMAGE']
+    return current_app.config['BASE_IMAGE']
+
+@template_filter
 def price(price):
     '''Return price value CSS formated'''
     if not price:
         return ''
-    price = Decimal("%0.2f" % (price))
-    p = str(price)
-    p = p.split('.')
-    
-    if not len(p) > 1:
-        decimals = '00'
-    else:
-        decimals = p[1][:2]
-
-    return '%s<span class="price-decimals">.%s</span>' % (p[0], decimals)
-
-@current_app.template_filter()
+    p = ('%0.2f' % price).split('.')
+    return '%s<span class="price-decimals">.%s</span>' % (p[0], p[1])
+
+@template_filter
+def prices(values):
+    '''Return list of prices values CSS formated
+
+    {% set labels = products|map(attribute='price')|prices %}
+    '''
+    return [price(v) for v in values]
+
+@template_filter
 def video(url):
     '''Return embed video or link
 
@@ -134,7 +120,7 @@ def video(url):
     html = '<a href="%(url)s" title="%(url)s">%(url)s</a>' % {'url': url}
     return html
 
-@current_app.template_filter()
+@template_filter
 def youtube(yid, size="normal"):
     '''Return embed Youtube
 
@@ -159,7 +145,7 @@ def youtube(yid, size="normal"):
         }
 filters.FILTERS['youtube'] = youtube
 
-@current_app.template_filter()
+@template_filter
 def vimeo(vid, size="normal"):
     '''Return embed Vimeo
 
@@ -186,7 +172,7 @@ def vimeo(vid, size="normal"):
         }
 filters.FILTERS['vimeo'] = vimeo
 
-@current_app.template_filter()
+@template_filter
 def slideshare(slid, size="normal"):
     '''Return embed Slideshare
 
@@ -212,14 +198,32 @@ def slideshare(slid, size="normal"):
         }
 filters.FILTERS['slideshare'] = slideshare
 
-@current_app.template_filter()
+# wikimarkup output by text hash, also in app.cache
+_wikimarkup_cache = LRUCache(1000, 10 * 1024 * 1024)
+
+@template_filter
+@timed('wikimarkup')
 def wikimarkup(text, show_toc=False):
-    '''Return html text from wiki format'''
-    text = wikiparse(text, show_toc)
-    t = Template(text)
-    return t.render()
+    '''Return html text from wiki format
+
+    Output only depends on text and show_toc: it is cached by their hash in
+    process and in app.cache, so wiki parsing and Jinja compilation only
+    run once by text.
+    '''
+    key = 'wikimarkup-%s-%s' % (hashlib.md5(text.encode('utf-8')
+            if isinstance(text, unicode) else text).hexdigest(),
+        1 if show_toc else 0)
+    html = _wikimarkup_cache.get(key)
+    if html is None:
+        html = current_app.cache.get(key)
+        if html is None:
+            t = Template(wikiparse(text, show_toc))
+            html = t.render()
+            current_app.cache.set(key, html)
+        _wikimarkup_cache.set(key, html, len(html))
+    return html
 
-@current_app.template_filter()
+@template_filter
 def dateformat(value, format='medium'):
     '''Return date time to format
 
@@ -228,9 +232,22 @@ def dateformat(value, format='medium'):
     date|dateformat('short')
     date|dateformat('dd mm yyyy')
     '''
-    return format_date(value, format)
+    if value is None:
+        return format_date(value, format)
+    return formatter('date', format)(value)
+
+@template_filter
+def dateformats(values, format='medium'):
+    '''Return list of dates to format
+
+    {% set dates = sales|map(attribute='sale_date')|dateformats('short') %}
+    '''
+    func = formatter('date', format)
+    # None is now, as in dateformat
+    return [func(v) if v is not None else format_date(v, format)
+        for v in values]
 
-@current_app.template_filter()
+@template_filter
 def datetimeformat(value, format='medium'):
     '''Return date time to format
 
@@ -239,9 +256,22 @@ def datetimeformat(value, format='medium'):
     datetime|datetimeformat('short')
     datetime|datetimeformat('dd mm yyyy')
     '''
-    return format_datetime(value, format)
+    if value is None:
+        return format_datetime(value, format)
+    return formatter('datetime', format)(value)
+
+@template_filter
+def datetimeformats(values, format='medium'):
+    '''Return list of date times to format
+
+    {% set dates = sales|map(attribute='create_date')|datetimeformats %}
+    '''
+    func = formatter('datetime', format)
+    # None is now, as in datetimeformat
+    return [func(v) if v is not None else format_datetime(v, format)
+        for v in values]
 
-@current_app.template_filter()
+@template_filter
 def state(state):
     '''Return state value from key'''
     states = {
@@ -263,7 +293,11 @@ def state(state):
         }
     return states[state] if states.get(state) else state
 
-@current_app.template_filter()
+@template_filter
 def quantity(qty):
     '''Return qty and decimals'''
-    return Decimal("%0.0f" % (qty))
+    try:
+        return Decimal(qty).quantize(_UNIT)
+    except InvalidOperation:
+        # more digits than the decimal context precision
+        return Decimal(qty)
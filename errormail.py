@@ -0,0 +1,276 @@
+#This file is part galatea app for Flask.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+'''Error mails out of the request
+
+Error records of app.logger are put in a bounded queue (dropped when it is
+full) and a background thread mails them to ADMINS, so a failing request
+never waits for the SMTP server.
+
+Records are grouped by signature (exception type and the place it was
+raised) in digests: a mail every MAIL_ERROR_INTERVAL seconds at most, with
+the first record of each signature and its count, and at most
+MAIL_ERROR_RATE mails an hour. While over the rate, records keep being
+counted in the next digest.
+
+LocalSMTP keeps mails in LocalSMTP.outbox instead of sending them, for
+tests and development:
+
+    init_error_mail(app, smtp=LocalSMTP)
+'''
+import Queue
+import atexit
+import copy
+import logging
+import os
+import smtplib
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from email.header import Header
+from email.mime.text import MIMEText
+from email.utils import formatdate
+
+# distinct signatures by digest, others are only counted
+MAX_SIGNATURES = 100
+# seconds to wait for the SMTP server
+SMTP_TIMEOUT = 10
+
+_STOP = object()
+
+
+def signature(record):
+    '''Return signature of a log record: exception type and the place it
+    was raised, or the place it was logged'''
+    if record.exc_info and record.exc_info[0]:
+        type_, _, tb = record.exc_info
+        frames = traceback.extract_tb(tb)
+        if frames:
+            filename, lineno, function, _ = frames[-1]
+            return '%s at %s:%s in %s' % (type_.__name__, filename, lineno,
+                function)
+        return type_.__name__
+    return '%s at %s:%s' % (record.levelname, record.pathname, record.lineno)
+
+
+class LocalSMTP(object):
+    '''SMTP stand-in: mails are appended to LocalSMTP.outbox as (from
+    address, to addresses, message)'''
+    outbox = []
+
+    def __init__(self, host='', port=0, timeout=None):
+        pass
+
+    def ehlo(self):
+        pass
+
+    def starttls(self, *args):
+        pass
+
+    def login(self, user, password):
+        pass
+
+    def sendmail(self, fromaddr, toaddrs, msg):
+        self.outbox.append((fromaddr, toaddrs, msg))
+
+    def quit(self):
+        pass
+
+
+class QueueHandler(logging.Handler):
+    '''Logging handler that puts formatted records in the queue of an
+    ErrorMailer'''
+
+    def __init__(self, mailer, level=logging.ERROR):
+        logging.Handler.__init__(self, level)
+        self.mailer = mailer
+        self.dropped = 0
+
+    def prepare(self, record):
+        '''Return a copy of record with its message and traceback formatted:
+        the traceback can not be formatted out of the thread. record is
+        left untouched for other handlers'''
+        msg = self.format(record)
+        record = copy.copy(record)
+        record.signature = signature(record)
+        record.msg = msg
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.mailer.start()
+            self.mailer.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class ErrorMailer(object):
+    '''Mail digests of the records of a queue from a background thread'''
+
+    def __init__(self, mailhost, fromaddr, toaddrs, subject,
+            credentials=None, secure=None, interval=60, rate=10,
+            queue_size=1000, smtp=smtplib.SMTP):
+        if isinstance(mailhost, (list, tuple)):
+            self.mailhost, self.mailport = mailhost
+        else:
+            self.mailhost, self.mailport = mailhost, None
+        self.fromaddr = fromaddr
+        self.toaddrs = list(toaddrs or [])
+        self.subject = subject
+        self.credentials = credentials
+        self.secure = secure
+        self.interval = interval
+        self.rate = rate
+        self.smtp = smtp
+        self.queue = Queue.Queue(queue_size)
+        self.sent = []
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # signature -> [count, first record]
+        self.pending = OrderedDict()
+        self.overflow = 0
+        self.first = None
+
+    def start(self):
+        '''Start the listener thread, again after a fork'''
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self.run,
+                name='error-mailer')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def stop(self, timeout=None):
+        '''Send pending records and stop the listener thread'''
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self.queue.put(_STOP)
+        self._thread.join(timeout)
+        self._pid = None
+
+    def add(self, record):
+        if self.first is None:
+            self.first = time.time()
+        entry = self.pending.get(record.signature)
+        if entry is None:
+            if len(self.pending) >= MAX_SIGNATURES:
+                self.overflow += 1
+                return
+            entry = self.pending[record.signature] = [0, record]
+        entry[0] += 1
+
+    def allowed(self):
+        '''Return True when a mail can be sent within the rate'''
+        now = time.time()
+        self.sent = [t for t in self.sent if now - t < 3600]
+        return len(self.sent) < self.rate
+
+    def run(self):
+        while True:
+            try:
+                record = self.queue.get(timeout=self.interval)
+            except Queue.Empty:
+                record = None
+            if record is _STOP:
+                self.flush()
+                break
+            if record is not None:
+                self.add(record)
+            if (self.first is not None
+                    and time.time() - self.first >= self.interval
+                    and self.allowed()):
+                self.flush()
+
+    def message(self):
+        '''Return digest mail of pending records'''
+        total = sum(e[0] for e in self.pending.itervalues()) + self.overflow
+        lines = []
+        for sig, (count, record) in self.pending.iteritems():
+            lines.append('%s time(s): %s' % (count, sig))
+            lines.append('')
+            lines.append(record.msg)
+            lines.append('')
+        if self.overflow:
+            lines.append('%s more error(s) of other signatures'
+                % self.overflow)
+        if isinstance(self.subject, unicode):
+            subject = self.subject
+        else:
+            subject = self.subject.decode('utf-8')
+        msg = MIMEText(u'\n'.join(l if isinstance(l, unicode)
+                else l.decode('utf-8', 'replace') for l in lines),
+            'plain', 'utf-8')
+        msg['Subject'] = Header(u'%s: %s error(s), %s distinct' % (subject,
+                total, len(self.pending)), 'utf-8')
+        msg['From'] = self.fromaddr
+        msg['To'] = ','.join(self.toaddrs)
+        msg['Date'] = formatdate()
+        return msg
+
+    def send(self, msg):
+        '''Send msg with SMTP like logging.handlers.SMTPHandler'''
+        port = self.mailport or smtplib.SMTP_PORT
+        smtp = self.smtp(self.mailhost, port, timeout=SMTP_TIMEOUT)
+        try:
+            if self.credentials:
+                if self.secure is not None:
+                    smtp.ehlo()
+                    smtp.starttls(*self.secure)
+                    smtp.ehlo()
+                smtp.login(*self.credentials)
+            smtp.sendmail(self.fromaddr, self.toaddrs, msg.as_string())
+        finally:
+            smtp.quit()
+
+    def flush(self):
+        '''Mail pending records as a digest'''
+        if not self.pending and not self.overflow:
+            return
+        try:
+            if self.toaddrs:
+                self.send(self.message())
+        except Exception:
+            # never raise from the listener: report like logging does
+            traceback.print_exc(file=sys.stderr)
+        finally:
+            self.sent.append(time.time())
+            self._reset()
+
+
+def init_error_mail(app, smtp=smtplib.SMTP):
+    '''Mail errors of app.logger to ADMINS out of the request. Return the
+    QueueHandler'''
+    config = app.config
+    mailhost = config.get('MAIL_SERVER')
+    if config.get('MAIL_PORT'):
+        mailhost = (mailhost, config['MAIL_PORT'])
+    mailer = ErrorMailer(mailhost,
+        fromaddr=config.get('DEFAULT_MAIL_SENDER'),
+        toaddrs=config.get('ADMINS'),
+        subject='Flask %s Failed' % config.get('TITLE'),
+        credentials=config.get('MAIL_CREDENTIALS', None),
+        secure=config.get('MAIL_SECURE', None),
+        interval=config.get('MAIL_ERROR_INTERVAL', 60),
+        rate=config.get('MAIL_ERROR_RATE', 10),
+        queue_size=config.get('MAIL_ERROR_QUEUE_SIZE', 1000),
+        smtp=smtp)
+    handler = QueueHandler(mailer)
+    app.logger.addHandler(handler)
+    # send the last digest on exit
+    atexit.register(mailer.stop, SMTP_TIMEOUT)
+    return handler
@@ -0,0 +1,68 @@
+#This file is part galatea app for Flask.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+'''Precompiled date and datetime formatters
+
+flask_babel format_date and format_datetime look up the locale and parse
+the pattern on each call. Formatters are compiled once by locale, timezone
+and format and reused across requests.
+'''
+from datetime import datetime as _datetime
+
+import pytz
+from babel.dates import get_date_format, get_datetime_format, \
+    get_time_format, parse_pattern
+from flask_babel import get_locale, get_timezone
+from cache import LRUCache
+
+NAMED_FORMATS = ('full', 'long', 'medium', 'short')
+
+_formatters = LRUCache(256)
+
+
+def _to_timezone(value, tzinfo):
+    '''Return datetime value in tzinfo timezone; naive values are UTC'''
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=pytz.UTC)
+    value = value.astimezone(tzinfo)
+    if hasattr(tzinfo, 'normalize'):
+        value = tzinfo.normalize(value)
+    return value
+
+def _compile(kind, format, locale, tzinfo):
+    if kind == 'date':
+        if format in NAMED_FORMATS:
+            format = get_date_format(format, locale=locale)
+        pattern = parse_pattern(format)
+        def formatter(value):
+            if isinstance(value, _datetime):
+                # date in the user timezone, like flask_babel format_date
+                value = _to_timezone(value, tzinfo).date()
+            return pattern.apply(value, locale)
+        return formatter
+
+    if format in NAMED_FORMATS:
+        template = get_datetime_format(format, locale=locale).replace("'", "")
+        date_pattern = parse_pattern(get_date_format(format, locale=locale))
+        time_pattern = parse_pattern(get_time_format(format, locale=locale))
+        def formatter(value):
+            value = _to_timezone(value, tzinfo)
+            return template.replace('{0}', time_pattern.apply(value, locale)
+                ).replace('{1}', date_pattern.apply(value, locale))
+        return formatter
+    pattern = parse_pattern(format)
+    def formatter(value):
+        return pattern.apply(_to_timezone(value, tzinfo), locale)
+    return formatter
+
+def formatter(kind, format='medium'):
+    '''Return function that formats a date (kind 'date') or a datetime
+    (kind 'datetime') in the locale and timezone of the request'''
+    locale = get_locale()
+    tzinfo = get_timezone()
+    key = (kind, format, str(locale), getattr(tzinfo, 'zone', str(tzinfo)))
+    func = _formatters.get(key)
+    if func is None:
+        func = _compile(kind, format, locale, tzinfo)
+        _formatters.set(key, func)
+    return func
@@ -0,0 +1,261 @@
+#This file is part galatea app for Flask.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+'''Lazy Tryton transactions
+
+Views decorated with lazy_transaction() start their Tryton transaction
+(and evaluate the default context) the first time tryton.pool is used, so
+views served from caches never touch the database. Transactions are run
+like flask_tryton's tryton.transaction() does: TRYTON_USER, read only but
+for PUT, POST, DELETE and PATCH requests, Tryton caches cleaned before and
+reset after, user errors as 400 responses. They are not retried on
+database operational errors: the view may have sent part of the response.
+
+tryton.pool must be replaced by a LazyPool:
+
+    tryton.pool = LazyPool(tryton.pool)
+
+With app.transaction_pool (a TransactionPool of TRYTON_POOL_SIZE), Tryton
+transactions of lazy_transaction() and tryton.transaction() (see
+bound_transactions) wait for a free slot, so threads never open more
+database connections than the pool size.
+'''
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app, request, g
+from werkzeug.exceptions import BadRequest, ServiceUnavailable
+try:
+    from trytond import __version__ as trytond_version
+except ImportError:
+    from trytond.version import VERSION as trytond_version
+from trytond.cache import Cache
+from trytond.exceptions import UserError, UserWarning, ConcurrencyException
+from trytond.transaction import Transaction
+from metrics import record, transaction_started, transaction_stopped, \
+    timed_transaction
+
+trytond_version = tuple(map(int, trytond_version.split('.')[:2]))
+# request methods of read-write transactions
+WRITE_METHODS = ('PUT', 'POST', 'DELETE', 'PATCH')
+
+
+class TransactionPool(object):
+    '''Bound the number of concurrent Tryton transactions of the process
+
+    A thread holds one slot for its nested transactions. Threads wait up to
+    timeout seconds for a slot (forever with None), then get a 503.
+    '''
+
+    def __init__(self, size, timeout=None):
+        self.size = size
+        self.timeout = timeout
+        self.used = 0
+        self._condition = threading.Condition(threading.Lock())
+        self._local = threading.local()
+
+    def acquire(self):
+        depth = getattr(self._local, 'depth', 0)
+        if depth:
+            self._local.depth = depth + 1
+            return
+        start = time.time()
+        with self._condition:
+            while self.used >= self.size:
+                remaining = None
+                if self.timeout is not None:
+                    remaining = start + self.timeout - time.time()
+                    if remaining <= 0:
+                        raise ServiceUnavailable(
+                            'No Tryton transaction available')
+                self._condition.wait(remaining)
+            self.used += 1
+        self._local.depth = 1
+        record('transaction_wait', time.time() - start)
+
+    def release(self):
+        self._local.depth -= 1
+        if self._local.depth:
+            return
+        with self._condition:
+            self.used -= 1
+            self._condition.notify()
+
+
+def transaction_pool():
+    '''Return TransactionPool of current app or None'''
+    return getattr(current_app, 'transaction_pool', None) \
+        if current_app else None
+
+@contextmanager
+def transaction_slot():
+    '''Hold a slot of the transaction pool of current app'''
+    pool = transaction_pool()
+    if pool is None:
+        yield
+        return
+    pool.acquire()
+    try:
+        yield
+    finally:
+        pool.release()
+
+def _bounded(transaction):
+    '''Return transaction decorator factory whose functions hold a slot of
+    the transaction pool and are timed'''
+    @wraps(transaction)
+    def bounded(*args, **kwargs):
+        decorator = transaction(*args, **kwargs)
+        def wrap(func):
+            decorated = timed_transaction(decorator(func))
+            @wraps(func)
+            def wrapper(*a, **kw):
+                with transaction_slot():
+                    return decorated(*a, **kw)
+            return wrapper
+        return wrap
+    bounded.bounded = True
+    return bounded
+
+def bound_transactions(tryton):
+    '''Make functions decorated with tryton.transaction() hold a slot of
+    the transaction pool and time their transaction.
+
+    The transaction() static method of the class of tryton (flask_tryton
+    Tryton) and its tryton_transaction alias are replaced, so it applies
+    to every Tryton object. Functions decorated before are not bounded:
+    call it before importing the modules that decorate them (galatea
+    blueprints).
+    '''
+    owner = type(tryton)
+    method = owner.__dict__.get('transaction')
+    if not isinstance(method, staticmethod):
+        # transaction() of old flask_tryton versions is a method
+        if not getattr(tryton.transaction, 'bounded', False):
+            tryton.transaction = _bounded(tryton.transaction)
+        return
+    transaction = method.__get__(None, owner)
+    if getattr(transaction, 'bounded', False):
+        return
+    bounded = _bounded(transaction)
+    owner.transaction = staticmethod(bounded)
+    module = sys.modules.get(owner.__module__)
+    if getattr(module, 'tryton_transaction', None) is transaction:
+        module.tryton_transaction = bounded
+
+
+class LazyPool(object):
+    '''Tryton pool proxy that starts the lazy transaction of the request'''
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        lazy = g.get('lazy_transaction') if g else None
+        if lazy is not None and not lazy.started:
+            lazy.start()
+        return getattr(self._pool, name)
+
+
+class LazyTransaction(object):
+    '''Tryton transaction started on demand'''
+
+    def __init__(self, tryton, readonly=None):
+        self.tryton = tryton
+        self.readonly = readonly
+        self.transaction = None
+        self.pool = None
+        self.start_time = None
+
+    @property
+    def started(self):
+        return self.transaction is not None
+
+    def start(self):
+        self.database = current_app.config['TRYTON_DATABASE']
+        user = int(current_app.config['TRYTON_USER'])
+        if self.readonly is None:
+            self.is_readonly = not (request
+                and request.method in WRITE_METHODS)
+        else:
+            self.is_readonly = self.readonly
+        self.pool = transaction_pool()
+        if self.pool:
+            self.pool.acquire()
+        try:
+            if trytond_version >= (3, 3):
+                with Transaction().start(self.database, 0):
+                    Cache.clean(self.database)
+            else:
+                Cache.clean(self.database)
+            context = {}
+            if getattr(self.tryton, 'context_callback', None):
+                with Transaction().start(self.database, user,
+                        readonly=True):
+                    context = self.tryton.context_callback()
+            self.start_time = transaction_started()
+            self.transaction = Transaction().start(self.database, user,
+                readonly=self.is_readonly, context=context)
+        except Exception:
+            transaction_stopped(self.start_time)
+            if self.pool:
+                self.pool.release()
+            raise
+
+    def stop(self, commit=True):
+        if not self.started:
+            return
+        transaction = self.transaction
+        try:
+            if hasattr(transaction, 'cursor'):
+                if commit and not self.is_readonly:
+                    transaction.cursor.commit()
+                else:
+                    transaction.cursor.rollback()
+            if commit and trytond_version >= (3, 3):
+                Cache.resets(self.database)
+        finally:
+            try:
+                transaction.stop()
+            finally:
+                self.transaction = None
+                if self.pool:
+                    self.pool.release()
+                transaction_stopped(self.start_time)
+        if commit and trytond_version < (3, 3):
+            Cache.resets(self.database)
+
+
+def lazy_transaction(tryton, readonly=None):
+    '''Decorator: run view with a lazy Tryton transaction
+
+    @app.route('/')
+    @lazy_transaction(tryton)
+    def index():
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            previous = g.get('lazy_transaction')
+            if previous is not None and previous.started:
+                # already in a transaction (error handler of a view)
+                return func(*args, **kwargs)
+            lazy = g.lazy_transaction = LazyTransaction(tryton, readonly)
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                started = lazy.started
+                lazy.stop(commit=False)
+                if started and isinstance(e, (UserError, UserWarning,
+                            ConcurrencyException)):
+                    raise BadRequest(e.message)
+                raise
+            finally:
+                g.lazy_transaction = previous
+            lazy.stop()
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,237 @@
+#This file is part galatea app for Flask.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+'''Maintenance commands
+
+python manage.py sitemap
+python manage.py thumbnails --profile 200x200:fit --profile 800x800
+python manage.py media-cache --evict
+python manage.py invalidate cms-block cms-menu
+python manage.py serve --threads 16
+'''
+import argparse
+import ast
+import multiprocessing
+import os
+import sys
+import time
+
+from flask import g
+from app import app
+
+# images extensions of attachments to create thumbnails
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif')
+# records read by query
+CHUNK_LIMIT = 1000
+
+
+def request_context():
+    '''Return a request context to run Tryton transactions out of a request'''
+    ctx = app.test_request_context('/', base_url=app.config.get('BASE_URL'))
+    ctx.push()
+    g.language = app.config.get('LANGUAGE')
+    return ctx
+
+
+def sitemap(args):
+    '''Rebuild precomputed sitemap files'''
+    from sitemap import refresh_sitemaps
+    start = time.time()
+    pages = refresh_sitemaps(app, args.folder)
+    if pages is None:
+        print >> sys.stderr, 'Sitemap is locked or failed to refresh'
+        return 1
+    print '%s sitemap files in %.1fs' % (pages, time.time() - start)
+    return 0
+
+def parse_profile(value):
+    '''Return thumbnail options (size, crop, bg, quality, format) from
+    SIZE[:CROP[:BG[:QUALITY[:FORMAT]]]] - 200x200:fit:(255, 255, 255, 0):85'''
+    from thumbnails import output_format
+
+    values = value.split(':')
+    size = values[0]
+    crop = values[1] if len(values) > 1 and values[1] else None
+    bg = ast.literal_eval(values[2]) if len(values) > 2 and values[2] else None
+    quality = int(values[3]) if len(values) > 3 and values[3] else 85
+    fmt = output_format(values[4]) if len(values) > 4 and values[4] else None
+    if len(size.split('x')) != 2:
+        raise argparse.ArgumentTypeError('Invalid size: %s' % size)
+    return size, crop, bg, quality, fmt
+
+def product_images():
+    '''Generate lists of (digest, name) of image attachments of products of
+    the shops, a list by CHUNK_LIMIT products'''
+    from galatea.tryton import tryton
+
+    shops = app.config.get('TRYTON_SALE_SHOPS')
+
+    @tryton.transaction()
+    def read(offset):
+        Template = tryton.pool.get('product.template')
+        Attachment = tryton.pool.get('ir.attachment')
+        templates = Template.search_read([
+            ('esale_active', '=', True),
+            ('esale_saleshops', 'in', shops),
+            ], offset=offset, limit=CHUNK_LIMIT, order=[('id', 'ASC')],
+            fields_names=['id'])
+        attachments = Attachment.search_read([
+            ('resource', 'in', ['product.template,%s' % t['id']
+                    for t in templates]),
+            ('digest', '!=', None),
+            ], fields_names=['digest', 'name'])
+        return len(templates), attachments
+
+    offset = 0
+    while True:
+        count, attachments = read(offset)
+        yield [(a['digest'], a['name']) for a in attachments
+            if os.path.splitext(a['name'])[1].lower() in IMAGE_EXTENSIONS]
+        if count < CHUNK_LIMIT:
+            break
+        offset += count
+
+def _uptodate(original, target):
+    try:
+        return os.path.getmtime(target) >= os.path.getmtime(original)
+    except OSError:
+        return False
+
+def thumbnails(args):
+    '''Create thumbnails of product images'''
+    from thumbnails import thumbnail_paths, generate_task
+
+    profiles = args.profile or [parse_profile(p)
+        for p in app.config.get('THUMBNAIL_PROFILES', [])]
+    if not profiles:
+        print >> sys.stderr, 'No thumbnail profiles (--profile or ' \
+            'THUMBNAIL_PROFILES)'
+        return 1
+
+    def tasks(images):
+        # generate() arguments of the thumbnails to create
+        result = []
+        for digest, name in images:
+            for size, crop, bg, quality, fmt in profiles:
+                original, target, _ = thumbnail_paths(app.config, digest,
+                    name, size, crop, bg, quality, fmt)
+                if _uptodate(original, target):
+                    stats['skipped'] += 1
+                    continue
+                width, height = [int(x) for x in size.split('x')]
+                result.append((original, target, width, height, crop, bg,
+                        quality, fmt, app.config.get('THUMBNAIL_MAX_PIXELS'),
+                        app.config.get('THUMBNAIL_PROGRESSIVE', False)))
+        return result
+
+    stats = {'skipped': 0, 'done': 0, 'failed': 0}
+    request_context()
+    start = time.time()
+    pool = multiprocessing.Pool(args.processes)
+    # Tryton is read in this thread (the request context is thread local):
+    # the pool only gets the tasks of each chunk
+    for images in product_images():
+        for target, filename in pool.imap_unordered(generate_task,
+                tasks(images), 8):
+            stats['done' if filename else 'failed'] += 1
+            if args.verbose and not filename:
+                print >> sys.stderr, 'Failed: %s' % target
+    pool.close()
+    pool.join()
+    elapsed = time.time() - start
+    print '%(done)s created, %(failed)s failed, %(skipped)s up to date' % stats
+    print '%.1fs, %.1f thumbnails/s' % (elapsed,
+        stats['done'] / elapsed if elapsed else 0)
+    return 0
+
+def media_cache(args):
+    '''Report thumbnails cache size and stats, evict old thumbnails'''
+    from cache import invalidate
+    from thumbnails import cache_files, evict
+
+    folder = app.config['MEDIA_CACHE_FOLDER']
+    files = cache_files(folder)
+    size = sum(f[1] for f in files)
+    print '%s: %s files, %.1f MB' % (folder, len(files), size / 1048576.)
+
+    stats = dict((k, app.cache.get('thumbnail-%s' % k) or 0)
+        for k in ('hits', 'misses', 'failed'))
+    requests = sum(stats.values())
+    stats['ratio'] = 100. * stats['hits'] / requests if requests else 0
+    print '%(hits)s hits, %(misses)s misses, %(failed)s failed ' \
+        '(%(ratio).1f%% hit ratio)' % stats
+
+    max_size = args.max_size or app.config.get('MEDIA_CACHE_MAX_SIZE')
+    if args.evict and max_size:
+        removed, removed_size = evict(folder, max_size, files, app.cache)
+        print 'Evicted %s files, %.1f MB' % (removed,
+            removed_size / 1048576.)
+        if removed:
+            # cached pages may link evicted thumbnails
+            with app.app_context():
+                invalidate('page')
+    return 0
+
+def invalidate(args):
+    '''Invalidate cached values of namespaces'''
+    from cache import invalidate as invalidate_namespace
+    with app.app_context():
+        for namespace in args.namespace:
+            invalidate_namespace(namespace)
+    print 'Invalidated %s' % ', '.join(args.namespace)
+    return 0
+
+def serve(args):
+    '''Serve the app with a pool of threads (development server)'''
+    from server import serve as serve_app
+    print 'Serving on http://%s:%s with %s threads' % (args.host, args.port,
+        args.threads)
+    serve_app(app, args.host, args.port, args.threads)
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description='Galatea app commands')
+    subparsers = parser.add_subparsers()
+
+    parser_sitemap = subparsers.add_parser('sitemap', help=sitemap.__doc__)
+    parser_sitemap.add_argument('--folder',
+        help='Destination folder (default SITEMAP_FOLDER)')
+    parser_sitemap.set_defaults(func=sitemap)
+
+    parser_thumbnails = subparsers.add_parser('thumbnails',
+        help=thumbnails.__doc__)
+    parser_thumbnails.add_argument('--profile', action='append',
+        type=parse_profile, metavar='SIZE[:CROP[:BG[:QUALITY[:FORMAT]]]]',
+        help='Thumbnail profile (default THUMBNAIL_PROFILES)')
+    parser_thumbnails.add_argument('--processes', type=int,
+        help='Number of processes (default all cores)')
+    parser_thumbnails.add_argument('--verbose', action='store_true')
+    parser_thumbnails.set_defaults(func=thumbnails)
+
+    parser_media_cache = subparsers.add_parser('media-cache',
+        help=media_cache.__doc__)
+    parser_media_cache.add_argument('--evict', action='store_true',
+        help='Remove least recently used thumbnails over max size')
+    parser_media_cache.add_argument('--max-size', type=int,
+        help='Max size in bytes (default MEDIA_CACHE_MAX_SIZE)')
+    parser_media_cache.set_defaults(func=media_cache)
+
+    parser_invalidate = subparsers.add_parser('invalidate',
+        help=invalidate.__doc__)
+    parser_invalidate.add_argument('namespace', nargs='+',
+        help='cms-menu, cms-block, cms-carousel, catalog-menu, page, '
+        'sitemap...')
+    parser_invalidate.set_defaults(func=invalidate)
+
+    parser_serve = subparsers.add_parser('serve', help=serve.__doc__)
+    parser_serve.add_argument('--host', default='127.0.0.1')
+    parser_serve.add_argument('--port', type=int, default=5000)
+    parser_serve.add_argument('--threads', type=int,
+        default=app.config.get('SERVER_THREADS', 16))
+    parser_serve.set_defaults(func=serve)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
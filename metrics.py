@@ -0,0 +1,267 @@
+#This file is part galatea app for Flask.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+'''Request instrumentation
+
+With METRICS, time of requests and of their stages (before_request hooks,
+Tryton transaction, context processors, filters, template rendering) and
+Tryton SQL queries are recorded by endpoint in histograms of the process,
+exposed in Prometheus text format on /metrics (for METRICS_ALLOW
+addresses).
+
+Lazy transactions and functions decorated with tryton.transaction() (see
+lazy_transaction.bound_transactions) are timed, and queries are counted on
+execute() of the cursor of the Tryton backend, so every view is measured.
+
+METRICS_SERVER_TIMING adds a Server-Timing header to responses and
+METRICS_PROFILE_RATE profiles a sample of requests, dumping the profile
+of those slower than METRICS_SLOW_REQUEST seconds to METRICS_PROFILE_DIR.
+'''
+import cProfile
+import os
+import random
+import sys
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, request, g, abort, Response, \
+    signals_available, before_render_template, template_rendered
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram(object):
+    '''Cumulative histogram of values by labels'''
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # counts by bucket, +Inf count and sum
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def lines(self, name):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, counts in values:
+            labels = ','.join('%s="%s"' % (k, v) for k, v in labels)
+            sep = ',' if labels else ''
+            for bound, count in zip(self.buckets, counts):
+                yield '%s_bucket{%s%sle="%s"} %s' % (name, labels, sep,
+                    bound, count)
+            yield '%s_bucket{%s%sle="+Inf"} %s' % (name, labels, sep,
+                counts[-2])
+            yield '%s_count{%s} %s' % (name, labels, counts[-2])
+            yield '%s_sum{%s} %s' % (name, labels, counts[-1])
+
+
+class Counter(object):
+    '''Counter by labels'''
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, value=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def lines(self, name):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield '%s{%s} %s' % (name, ','.join('%s="%s"' % (k, v)
+                    for k, v in labels), value)
+
+
+REQUEST_SECONDS = Histogram()
+STAGE_SECONDS = Histogram()
+TRYTON_CALLS = Counter()
+
+METRICS = (
+    ('galatea_request_seconds', 'histogram', 'Request time',
+        REQUEST_SECONDS),
+    ('galatea_stage_seconds', 'histogram', 'Request stage time',
+        STAGE_SECONDS),
+    ('galatea_tryton_calls_total', 'counter', 'Tryton SQL queries',
+        TRYTON_CALLS),
+    )
+
+
+def enabled():
+    return bool(g) and g.get('metrics_start') is not None
+
+def record(stage, seconds):
+    '''Add seconds to a stage of current request'''
+    if not enabled():
+        return
+    timings = g.metrics_timings
+    timings[stage] = timings.get(stage, 0) + seconds
+    STAGE_SECONDS.observe((('endpoint', request.endpoint), ('stage', stage)),
+        seconds)
+
+def tryton_call(count=1):
+    '''Count Tryton calls (queries) of current request'''
+    if not enabled():
+        return
+    g.metrics_tryton_calls += count
+    TRYTON_CALLS.inc((('endpoint', request.endpoint),), count)
+
+def transaction_started():
+    '''Mark start of a Tryton transaction of current request. Return start
+    time, or None when it is not measured (nested transaction)'''
+    if not enabled() or g.get('metrics_transaction'):
+        return None
+    g.metrics_transaction = True
+    return time.time()
+
+def transaction_stopped(start):
+    '''Record time of a transaction since start (of transaction_started)'''
+    if start is None or not enabled():
+        return
+    g.metrics_transaction = False
+    record('transaction', time.time() - start)
+
+def timed_transaction(func):
+    '''Decorator: record time of func, run in a Tryton transaction, as the
+    'transaction' stage of the request'''
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = transaction_started()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            transaction_stopped(start)
+    return wrapper
+
+def count_queries():
+    '''Count queries of requests on execute() of the cursor class of the
+    Tryton backend. Return False when the backend has none'''
+    try:
+        from trytond import backend
+        Cursor = sys.modules[backend.get('Database').__module__].Cursor
+    except (ImportError, AttributeError, KeyError):
+        return False
+    execute = Cursor.execute
+    if getattr(execute, 'counted', False):
+        return True
+
+    @wraps(execute)
+    def counted(self, *args, **kwargs):
+        tryton_call()
+        return execute(self, *args, **kwargs)
+    counted.counted = True
+    Cursor.execute = counted
+    return True
+
+def timed(stage):
+    '''Decorator: record time of function as a stage of the request'''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(stage, time.time() - start)
+        return wrapper
+    return decorator
+
+def _start():
+    g.metrics_start = time.time()
+    g.metrics_timings = {}
+    g.metrics_tryton_calls = 0
+    g.metrics_transaction = False
+    g.metrics_profile = None
+    rate = current_app.config.get('METRICS_PROFILE_RATE')
+    if rate and random.random() < rate:
+        g.metrics_profile = cProfile.Profile()
+        g.metrics_profile.enable()
+
+def _before_request_done():
+    record('before_request', time.time() - g.metrics_start)
+
+def _after_request(response):
+    if not enabled():
+        return response
+    config = current_app.config
+    seconds = time.time() - g.metrics_start
+    g.metrics_start = None
+    REQUEST_SECONDS.observe((('endpoint', request.endpoint),
+            ('status', response.status_code)), seconds)
+
+    if config.get('METRICS_SERVER_TIMING'):
+        timings = ['%s;dur=%.1f' % (k, v * 1000)
+            for k, v in sorted(g.metrics_timings.iteritems())]
+        timings.append('tryton;desc="%s queries"' % g.metrics_tryton_calls)
+        timings.append('total;dur=%.1f' % (seconds * 1000))
+        response.headers['Server-Timing'] = ', '.join(timings)
+
+    profile = g.metrics_profile
+    if profile:
+        profile.disable()
+        if seconds > config.get('METRICS_SLOW_REQUEST', 1):
+            folder = config.get('METRICS_PROFILE_DIR') or '/tmp'
+            profile.dump_stats(os.path.join(folder, '%s-%s-%s.prof' % (
+                        request.endpoint, int(time.time()), os.getpid())))
+    return response
+
+def _template_start(sender, template, context, **extra):
+    if enabled():
+        if not hasattr(g, 'metrics_templates'):
+            g.metrics_templates = []
+        g.metrics_templates.append(time.time())
+
+def _template_done(sender, template, context, **extra):
+    if enabled() and g.get('metrics_templates'):
+        record('render', time.time() - g.metrics_templates.pop())
+
+def metrics():
+    '''Metrics in Prometheus text format
+
+    Access is checked against the address of the connection: ProxyFix
+    takes remote_addr (and REMOTE_ADDR) from X-Forwarded-For, sent by any
+    client.
+    '''
+    environ = request.environ
+    addr = environ.get('werkzeug.proxy_fix.orig_remote_addr',
+        environ.get('REMOTE_ADDR'))
+    if addr not in current_app.config.get('METRICS_ALLOW', ['127.0.0.1']):
+        abort(404)
+    lines = []
+    for name, kind, help, metric in METRICS:
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+        lines.extend(metric.lines(name))
+    return Response('\n'.join(lines) + '\n',
+        mimetype='text/plain; version=0.0.4')
+
+def init_metrics(app):
+    '''Install instrumentation in app when METRICS is enabled. Call it
+    after registering before_request hooks of app, to time them.'''
+    if not app.config.get('METRICS'):
+        return
+    if not count_queries():
+        app.logger.warning('Tryton queries can not be counted: the backend '
+            'has no cursor class')
+    app.before_request_funcs.setdefault(None, []).insert(0, _start)
+    app.before_request_funcs[None].append(_before_request_done)
+    # after_request functions run in reverse order: this one runs last
+    app.after_request_funcs.setdefault(None, []).insert(0, _after_request)
+    app.add_url_rule('/metrics', 'metrics', metrics)
+    if signals_available:
+        before_render_template.connect(_template_start, app)
+        template_rendered.connect(_template_done, app)
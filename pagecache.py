@@ -0,0 +1,124 @@
+#This file is part galatea app for Flask.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+'''Full page cache for anonymous visitors
+
+Pages of PAGE_CACHE_ENDPOINTS are cached by path, PAGE_CACHE_QUERY_ARGS
+arguments and images formats accepted by the browser when the visitor has
+no session: a session cookie may carry values of the visitor (csrf_token)
+that must not be shared. Pages with other query arguments are not cached.
+Cached pages are returned by a before_request hook, so the view (and its Tryton
+transaction) does not run. Pages are stored minified (MINIFY) and
+compressed (gzip and, with the brotli module, br) with an ETag: repeated
+views get a 304.
+
+Cached pages expire after PAGE_CACHE_TIMEOUT seconds or when
+cache.invalidate('page') is called.
+'''
+import hashlib
+
+from flask import current_app, request, session, g, Response
+from werkzeug.urls import url_encode
+from cache import cache_key
+from compression import encodings, compress, gunzip, minify, \
+    accepted_encoding, encode_response
+
+# pages from 200 responses only
+CACHE_STATUS = (200,)
+
+
+def anonymous():
+    '''Return True when visitor has no session cookie and an empty session'''
+    return (current_app.session_cookie_name not in request.cookies
+        and not session)
+
+def query_string():
+    '''Return sorted PAGE_CACHE_QUERY_ARGS arguments of current request or
+    None if there are other arguments'''
+    allowed = current_app.config.get('PAGE_CACHE_QUERY_ARGS', [])
+    if any(k not in allowed for k in request.args):
+        return None
+    return url_encode(sorted(request.args.items(multi=True)))
+
+def page_key():
+    '''Return cache key of current page or None if it is not cacheable'''
+    config = current_app.config
+    if not config.get('PAGE_CACHE') or request.method not in ('GET', 'HEAD'):
+        return None
+    if request.endpoint not in config.get('PAGE_CACHE_ENDPOINTS', []):
+        return None
+    if not anonymous():
+        return None
+    query = query_string()
+    if query is None:
+        return None
+    # thumbnail format may be chosen from Accept header
+    accept = [m for m, q in request.accept_mimetypes]
+    images = ','.join(f for f in ('avif', 'webp') if 'image/' + f in accept)
+    path = request.path + '?' + query
+    return cache_key('page', 'anonymous', images,
+        hashlib.md5(path.encode('utf-8')).hexdigest())
+
+def _variants(page):
+    '''Return compressed bodies of a cached page by encoding'''
+    # 'body' is the gzip variant
+    return dict((e, page['body'] if e == 'gzip' else page.get(e))
+        for e in encodings() if e == 'gzip' or page.get(e))
+
+def _encode(response, page, body=None):
+    variants = _variants(page)
+    encoding = accepted_encoding(variants.keys())
+    if encoding:
+        encode_response(response, variants[encoding], encoding)
+    else:
+        encode_response(response,
+            gunzip(page['body']) if body is None else body, None)
+    response.vary.add('Cookie')
+    response.vary.add('Accept')
+    response.set_etag(page['etag'])
+    return response.make_conditional(request)
+
+def page_response(page):
+    '''Return response of a cached page'''
+    return _encode(Response(mimetype=page['mimetype']), page)
+
+def cached_page():
+    '''before_request hook: return cached page'''
+    # set on every request: cache_page() must never see the key of another
+    # request
+    key = g.page_cache_key = page_key()
+    g.page_cache_hit = g.thumbnail_pending = False
+    if not key:
+        return None
+    page = current_app.cache.get(key)
+    if page is None:
+        return None
+    g.page_cache_hit = True
+    return page_response(page)
+
+def cache_page(response):
+    '''after_request hook: cache page and answer conditional requests'''
+    key = getattr(g, 'page_cache_key', None)
+    if (not key or getattr(g, 'page_cache_hit', False)
+            or getattr(g, 'thumbnail_pending', False)
+            or response.status_code not in CACHE_STATUS
+            or response.mimetype != 'text/html'
+            or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or session.modified or session):
+        return response
+
+    body = response.get_data()
+    if current_app.config.get('MINIFY'):
+        body = minify(body, response.mimetype)
+    page = {
+        'body': compress(body, 'gzip'),
+        'mimetype': response.mimetype,
+        'etag': hashlib.md5(body).hexdigest(),
+        }
+    for encoding in encodings():
+        if encoding != 'gzip':
+            page[encoding] = compress(body, encoding)
+    current_app.cache.set(key, page,
+        timeout=current_app.config.get('PAGE_CACHE_TIMEOUT', 300))
+    return _encode(response, page, body)
@@ -0,0 +1,116 @@
+#This file is part galatea app for Flask.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+'''Preload in a master process and fork workers
+
+warmup() loads what workers would load on their first requests (Tryton
+pool, compiled templates, CMS data of WARMUP_CMS in app.cache) and closes
+database connections, so forked workers share that memory and open their
+own connections. post_fork() resets per-process state in the workers.
+
+gunicorn configuration (gunicorn.conf.py):
+
+    preload_app = True
+    from prefork import pre_fork, post_fork
+
+with WARMUP = True in config.cfg.
+'''
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+# template extensions compiled on warmup
+TEMPLATE_EXTENSIONS = ('html', 'xml', 'txt')
+
+
+def close_connections():
+    '''Close Tryton database connections of this process: they are opened
+    again on next transaction'''
+    try:
+        from trytond import backend
+        Database = backend.get('Database')
+    except (ImportError, AttributeError):
+        return
+    for database in getattr(Database, '_databases', {}).values():
+        try:
+            database.close()
+        except Exception:
+            logger.exception('Closing database %s failed',
+                getattr(database, 'database_name', ''))
+
+def compile_templates(app):
+    '''Load and compile templates of app and blueprints. Return count'''
+    env = app.jinja_env
+    count = 0
+    for name in env.list_templates(extensions=TEMPLATE_EXTENSIONS):
+        try:
+            env.get_template(name)
+        except Exception:
+            logger.exception('Template %s can not be compiled', name)
+            continue
+        count += 1
+    return count
+
+def preload_cms(app):
+    '''Load CMS data of WARMUP_CMS (prefetch_cms arguments) in app.cache
+    for each language. It initializes the Tryton pool'''
+    from flask import g
+    from galatea.tryton import tryton
+    from lazy_transaction import lazy_transaction
+    from context_processors import prefetch_cms
+
+    kwargs = app.config.get('WARMUP_CMS') or {}
+    languages = [k.split('_')[0] for k in
+        app.config.get('ACCEPT_LANGUAGES') or {}] or \
+        [app.config.get('LANGUAGE')]
+
+    @lazy_transaction(tryton)
+    def load():
+        # first pool access starts the transaction and loads the pool
+        tryton.pool.get('ir.model')
+        prefetch_cms(**kwargs)
+
+    for lang in languages:
+        with app.test_request_context('/%s/' % lang,
+                base_url=app.config.get('BASE_URL')):
+            g.language = lang
+            load()
+
+def warmup(app):
+    '''Load Tryton pool, templates and CMS caches of app before fork'''
+    start = time.time()
+    try:
+        preload_cms(app)
+    except Exception:
+        logger.exception('Preloading Tryton and CMS data failed')
+    templates = compile_templates(app)
+    close_connections()
+    logger.info('Warmup: %s templates in %.1fs', templates,
+        time.time() - start)
+
+def reset_process(app):
+    '''Reset state inherited from the master process: random seed and
+    connections of the shared cache'''
+    random.seed()
+    cache = getattr(app.cache, 'backend', app.cache)
+    client = getattr(cache, '_client', None)
+    if hasattr(client, 'disconnect_all'):
+        # memcache
+        client.disconnect_all()
+    elif hasattr(client, 'connection_pool'):
+        # redis
+        client.connection_pool.disconnect()
+    # the thumbnails process pool and the error mail thread are created
+    # again by process on first use
+    close_connections()
+
+def pre_fork(server, worker):
+    '''gunicorn hook: workers must not share database connections'''
+    close_connections()
+
+def post_fork(server, worker):
+    '''gunicorn hook'''
+    from app import app
+    reset_process(app)
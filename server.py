@@ -0,0 +1,69 @@
+#This file is part galatea app for Flask.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+'''Thread pool WSGI server for development and tests
+
+It is built on the werkzeug development server: in production, serve the
+app with gunicorn gthread workers (gunicorn --worker-class gthread
+--threads 16 app:app).
+
+Requests are served by a fixed number of threads sharing the memory of
+one process. Accepted connections wait in a bounded queue; when it is
+full the server stops accepting and new connections wait in the listen
+backlog. Keep TRYTON_POOL_SIZE close to the number of threads.
+
+python manage.py serve --threads 16
+'''
+import Queue
+import threading
+
+from werkzeug.serving import BaseWSGIServer
+
+
+class ThreadPoolMixIn(object):
+    '''SocketServer mix-in: process requests in a pool of threads'''
+    threads = 16
+    queue_size = 64
+
+    def start_threads(self):
+        self.requests = Queue.Queue(self.queue_size)
+        for i in range(self.threads):
+            thread = threading.Thread(target=self.process_queue,
+                name='wsgi-%s' % i)
+            thread.daemon = True
+            thread.start()
+
+    def process_queue(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+
+class ThreadPoolWSGIServer(ThreadPoolMixIn, BaseWSGIServer):
+    multithread = True
+
+    def __init__(self, host, port, app, threads=16, queue_size=None,
+            **kwargs):
+        BaseWSGIServer.__init__(self, host, port, app, **kwargs)
+        self.threads = threads
+        self.queue_size = queue_size or threads * 4
+        self.start_threads()
+
+
+def serve(app, host='127.0.0.1', port=5000, threads=16, queue_size=None):
+    '''Serve app with a pool of threads until interrupted'''
+    server = ThreadPoolWSGIServer(host, port, app, threads, queue_size)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
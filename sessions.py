@@ -0,0 +1,129 @@
+#This file is part galatea app for Flask.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+'''Sessions without storage I/O for anonymous visitors
+
+HybridSessionInterface wraps a session interface (the backend, like
+GalateaSessionInterface):
+
+- Without session cookie, the session is empty and nothing is loaded. If
+  it is still empty at the end of the request, no cookie is set, so
+  anonymous responses can be cached downstream.
+- Sessions with SESSION_COOKIE_KEYS keys only (small anonymous values,
+  never the customer or login flags) up to SESSION_COOKIE_MAX_SIZE bytes
+  are stored in a signed cookie (like Flask sessions: readable, not
+  writable, by the visitor). Other ones are moved to the backend and stay
+  there.
+- Sessions are saved when their content changed and, with
+  SESSION_REFRESH_EACH_REQUEST, permanent sessions are saved again on each
+  request to renew their expiry.
+
+SESSION_COOKIE_MAX_SIZE = 0 stores all sessions in the backend.
+'''
+import cPickle as pickle
+import hashlib
+
+from flask import request
+from flask.sessions import SessionInterface, SecureCookieSession, \
+    SecureCookieSessionInterface
+from itsdangerous import BadSignature
+
+# prefix of cookie values of signed cookie sessions (backend ids otherwise)
+COOKIE_PREFIX = 'c.'
+# session keys that can be stored in the cookie
+COOKIE_KEYS = ('_flashes', 'csrf_token', 'next')
+
+
+def digest(session):
+    '''Return hash of session content'''
+    return hashlib.md5(pickle.dumps(sorted(dict(session).items()),
+            pickle.HIGHEST_PROTOCOL)).hexdigest()
+
+
+class HybridSessionInterface(SessionInterface):
+    '''Signed cookie sessions for small sessions, backend for big ones'''
+
+    def __init__(self, backend, max_cookie_size=2048, cookie_keys=None):
+        self.backend = backend
+        self.max_cookie_size = max_cookie_size
+        self.cookie_keys = frozenset(COOKIE_KEYS if cookie_keys is None
+            else cookie_keys)
+        self.cookie_interface = SecureCookieSessionInterface()
+
+    def _mark(self, session, storage):
+        session.storage = storage
+        session.digest = digest(session) if storage else None
+        return session
+
+    def open_session(self, app, request):
+        value = request.cookies.get(app.session_cookie_name)
+        if not value:
+            return self._mark(SecureCookieSession(), None)
+        if not value.startswith(COOKIE_PREFIX):
+            session = self.backend.open_session(app, request)
+            if session is None:
+                return None
+            return self._mark(session, 'backend')
+
+        serializer = self.cookie_interface.get_signing_serializer(app)
+        if serializer is None:
+            return None
+        max_age = int(app.permanent_session_lifetime.total_seconds())
+        try:
+            data = serializer.loads(value[len(COOKIE_PREFIX):],
+                max_age=max_age)
+        except BadSignature:
+            # expired or tampered: start again, the cookie is deleted
+            session = SecureCookieSession()
+            session.storage, session.digest = 'cookie', None
+            return session
+        return self._mark(SecureCookieSession(data), 'cookie')
+
+    def _backend_session(self, app, request, session):
+        '''Return a new backend session with the content of session'''
+        # no cookie: the backend creates a session without loading one
+        environ = dict(request.environ, HTTP_COOKIE='')
+        backend_session = self.backend.open_session(app,
+            app.request_class(environ))
+        backend_session.update(dict(session))
+        backend_session.permanent = session.permanent
+        return backend_session
+
+    def refresh(self, app, session):
+        '''Return True when an unchanged session is saved to renew its
+        expiry'''
+        return session.permanent and \
+            app.config.get('SESSION_REFRESH_EACH_REQUEST', True)
+
+    def save_session(self, app, session, response):
+        storage = getattr(session, 'storage', None)
+        changed = not storage or session.digest != digest(session)
+        if storage == 'backend':
+            if changed or self.refresh(app, session):
+                self.backend.save_session(app, session, response)
+            return
+
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if storage:
+                response.delete_cookie(app.session_cookie_name,
+                    domain=domain, path=path)
+            return
+        if not changed and not self.refresh(app, session):
+            return
+
+        value = None
+        if self.max_cookie_size and self.cookie_keys.issuperset(session):
+            serializer = self.cookie_interface.get_signing_serializer(app)
+            value = COOKIE_PREFIX + serializer.dumps(dict(session))
+            if len(value) > self.max_cookie_size:
+                value = None
+        if value is None:
+            self.backend.save_session(app,
+                self._backend_session(app, request, session), response)
+            return
+        response.set_cookie(app.session_cookie_name, value,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain, path=path, secure=self.get_cookie_secure(app))
@@ -0,0 +1,267 @@
+#This file is part galatea app for Flask.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+from flask import current_app, url_for, g, send_file
+from werkzeug.urls import url_quote
+from xml.sax.saxutils import escape
+from galatea.tryton import tryton
+from compression import SUFFIXES, encodings, compress, accepted_encoding
+from cache import cached
+
+import gzip
+import os
+import tempfile
+import threading
+import time
+
+# urls by sitemap file (sitemaps protocol limit)
+SITEMAP_LIMIT = 50000
+# records read by query
+CHUNK_LIMIT = 1000
+
+_SLUG = '__slug__'
+# seconds after a refresh lock is considered abandoned
+LOCK_TIMEOUT = 3600
+
+_refresh_lock = threading.Lock()
+
+
+def sitemap_sources():
+    '''Return sitemap sources by name: model, domain, slugs field and
+    endpoint function by locale'''
+    galatea_website = current_app.config.get('TRYTON_GALATEA_SITE')
+    shops = current_app.config.get('TRYTON_SALE_SHOPS')
+    return {
+        'articles': ('galatea.cms.article', [
+                ('active', '=', True),
+                ('galatea_website', '=', galatea_website),
+                ], 'slug_langs', lambda locale: 'cms.article'),
+        'products': ('product.template', [
+                ('esale_active', '=', True),
+                ('esale_saleshops', 'in', shops),
+                ], 'esale_slug_langs', lambda locale: 'catalog.product_'+locale),
+        }
+
+def records_per_sitemap():
+    '''Return records by sitemap file: each record has an url by language'''
+    languages = current_app.config.get('ACCEPT_LANGUAGES') or {None: None}
+    return max(SITEMAP_LIMIT // len(languages), 1)
+
+@tryton.transaction()
+def sitemap_pages():
+    '''Return list of (name, page) of sitemap files'''
+    sources = sitemap_sources()
+    per_sitemap = records_per_sitemap()
+    pages = []
+    for name in sorted(sources):
+        model, domain, _, _ = sources[name]
+        Model = tryton.pool.get(model)
+        total = Model.search_count(domain)
+        pages.extend((name, p) for p in
+            range(1, (total + per_sitemap - 1) // per_sitemap + 1))
+    return pages
+
+@cached(3500, 'sitemap')
+def cached_sitemap_pages():
+    '''Return sitemap_pages() from cache, by website and language'''
+    return sitemap_pages()
+
+@tryton.transaction()
+def _search_read(model, domain, offset, limit, fields_names):
+    Model = tryton.pool.get(model)
+    return Model.search_read(domain, offset=offset, limit=limit,
+        order=[('id', 'ASC')], fields_names=fields_names)
+
+def sitemap_urls(name, page):
+    '''Generate lists of urls of a sitemap page, a list by query
+
+    Records are read by chunks (each chunk in its own transaction) and
+    urls are built from an url template by endpoint and locale instead of
+    calling url_for for each slug.
+    '''
+    model, domain, field, endpoint = sitemap_sources()[name]
+    per_sitemap = records_per_sitemap()
+    base_url = current_app.config.get('BASE_URL', '')
+
+    templates = {}
+    def url_template(locale):
+        if locale not in templates:
+            url = url_for(endpoint(locale), lang=locale, slug=_SLUG)
+            prefix, suffix = url.split(_SLUG, 1)
+            templates[locale] = (base_url + prefix, suffix)
+        return templates[locale]
+
+    offset = (page - 1) * per_sitemap
+    end = offset + per_sitemap
+    while offset < end:
+        limit = min(CHUNK_LIMIT, end - offset)
+        records = _search_read(model, domain, offset, limit, [field])
+        urls = []
+        for record in records:
+            for k, v in (record[field] or {}).iteritems():
+                if not v:
+                    continue
+                prefix, suffix = url_template(k[:2])
+                urls.append(prefix + url_quote(v) + suffix)
+        yield urls
+        if len(records) < limit:
+            break
+        offset += len(records)
+
+def _newline():
+    '''Return line separator of XML: none with MINIFY'''
+    return '' if current_app.config.get('MINIFY') else '\n'
+
+def sitemap_xml(name, page):
+    '''Generate XML of a sitemap page'''
+    nl = _newline()
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n' \
+        '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">' + nl
+    for urls in sitemap_urls(name, page):
+        yield ''.join('<url><loc>%s</loc></url>%s' % (escape(url), nl)
+            for url in urls)
+    yield '</urlset>\n'
+
+def sitemap_index_xml(pages):
+    '''Generate XML of the sitemap index'''
+    base_url = current_app.config.get('BASE_URL', '')
+    nl = _newline()
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n' \
+        '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">' \
+        + nl
+    for name, page in pages:
+        url = base_url + url_for('sitemap_page', name=name, page=page)
+        yield '<sitemap><loc>%s</loc></sitemap>%s' % (escape(url), nl)
+    yield '</sitemapindex>\n'
+
+def sitemap_folder():
+    '''Return folder of the precomputed sitemap files'''
+    return current_app.config.get('SITEMAP_FOLDER') or \
+        os.path.join(current_app.config['MEDIA_FOLDER'], 'sitemap')
+
+def write_file(folder, filename, chunks):
+    '''Write chunks to filename and its compressed versions (filename.gz
+    and, with the brotli module, filename.br)
+
+    Files are written to temporary files and renamed, so readers always
+    get a complete copy.
+    '''
+    fd, tmp = tempfile.mkstemp(dir=folder, prefix='.tmp')
+    fd_gz, tmp_gz = tempfile.mkstemp(dir=folder, prefix='.tmp')
+    tmp_br = None
+    try:
+        with os.fdopen(fd, 'wb') as f, os.fdopen(fd_gz, 'wb') as f_gz:
+            gz = gzip.GzipFile(filename, 'wb', 9, f_gz, mtime=0)
+            for chunk in chunks:
+                chunk = chunk.encode('utf-8')
+                f.write(chunk)
+                gz.write(chunk)
+            gz.close()
+        if 'br' in encodings():
+            # brotli has no stream API common to its bindings
+            with open(tmp, 'rb') as f:
+                data = compress(f.read(), 'br', best=True)
+            fd_br, tmp_br = tempfile.mkstemp(dir=folder, prefix='.tmp')
+            with os.fdopen(fd_br, 'wb') as f_br:
+                f_br.write(data)
+            os.chmod(tmp_br, 0o644)
+            os.rename(tmp_br, os.path.join(folder, filename + '.br'))
+        os.chmod(tmp, 0o644)
+        os.chmod(tmp_gz, 0o644)
+        os.rename(tmp_gz, os.path.join(folder, filename + '.gz'))
+        os.rename(tmp, os.path.join(folder, filename))
+    finally:
+        for path in (tmp, tmp_gz, tmp_br):
+            if path and os.path.exists(path):
+                os.remove(path)
+
+def build_sitemaps(folder):
+    '''Write sitemap index and sitemap files to folder. Return the number
+    of sitemap files'''
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    pages = sitemap_pages()
+    filenames = set(['sitemap.xml'])
+    for name, page in pages:
+        filename = 'sitemap-%s-%s.xml' % (name, page)
+        write_file(folder, filename, sitemap_xml(name, page))
+        filenames.add(filename)
+    write_file(folder, 'sitemap.xml', sitemap_index_xml(pages))
+
+    # remove pages of a previous, bigger, sitemap
+    for filename in os.listdir(folder):
+        name, ext = os.path.splitext(filename)
+        if ext not in SUFFIXES.values():
+            name = filename
+        if filename.startswith('sitemap') and name not in filenames:
+            os.remove(os.path.join(folder, filename))
+    return len(pages)
+
+def refresh_sitemaps(app, folder=None):
+    '''Rebuild sitemap files of app unless another thread or process is
+    rebuilding them. Return the number of sitemap files or None'''
+    with app.test_request_context('/', base_url=app.config.get('BASE_URL')):
+        g.language = app.config.get('LANGUAGE')
+        folder = folder or sitemap_folder()
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        lock = os.path.join(folder, '.lock')
+        try:
+            if time.time() - os.path.getmtime(lock) > LOCK_TIMEOUT:
+                os.remove(lock)
+        except OSError:
+            pass
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            return None
+        try:
+            return build_sitemaps(folder)
+        except Exception:
+            app.logger.exception('Sitemap refresh failed')
+        finally:
+            os.close(fd)
+            os.remove(lock)
+
+def _refresh(app, folder):
+    try:
+        refresh_sitemaps(app, folder)
+    finally:
+        _refresh_lock.release()
+
+def serve_sitemap(filename):
+    '''Return response of a precomputed sitemap file or None
+
+    The last good copy is always served. A refresh runs in a background
+    thread when the sitemap index is older than SITEMAP_TIMEOUT or does not
+    exist: a missing page file does not trigger it.
+    '''
+    folder = sitemap_folder()
+    path = os.path.join(folder, filename)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        mtime = None
+    try:
+        index_mtime = os.path.getmtime(os.path.join(folder, 'sitemap.xml'))
+    except OSError:
+        index_mtime = None
+    timeout = current_app.config.get('SITEMAP_TIMEOUT', 3500)
+    if (index_mtime is None or time.time() - index_mtime > timeout) and \
+            _refresh_lock.acquire(False):
+        thread = threading.Thread(target=_refresh,
+            args=(current_app._get_current_object(), folder))
+        thread.daemon = True
+        thread.start()
+    if mtime is None:
+        return None
+
+    encoding = accepted_encoding([e for e in encodings()
+            if os.path.exists(path + SUFFIXES[e])])
+    response = send_file(path + SUFFIXES[encoding] if encoding else path,
+        mimetype='application/xml', conditional=True)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
@@ -0,0 +1,388 @@
+#This file is part galatea app for Flask.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+import errno
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    raise RuntimeError('Image module of PIL needs to be installed')
+from trytond.config import CONFIG as tryton_config
+from cache import LRUCache
+
+# seconds after a generation lock file is considered abandoned
+LOCK_TIMEOUT = 60
+# thumbnail requests counted in process before adding them to shared stats
+STATS_FLUSH = 100
+# seconds a thumbnail is known to exist before checking the file again
+INDEX_TIMEOUT = 3600
+# shared cache key of the version of evictions
+EVICTION_KEY = 'thumbnail-evictions'
+# seconds between checks of the version of evictions
+EVICTION_CHECK = 30
+# seconds a failed thumbnail is not generated again
+FAILED_TIMEOUT = 300
+# failed thumbnails kept in process
+FAILED_SIZE = 10000
+# processes of the pool of each web process when THUMBNAIL_PROCESSES is unset
+DEFAULT_PROCESSES = 2
+# thumbnail output formats and their extension
+FORMATS = {
+    'jpeg': '.jpg',
+    'png': '.png',
+    'webp': '.webp',
+    'avif': '.avif',
+    }
+
+
+def thumbnail_name(name, fm, *args):
+    '''Return file name of a thumbnail from original name, extension and
+    thumbnail options
+
+    thumbnail_name('test', '.jpg', '100x100', 'fit', None, 85)
+    -> 'test_100x100_fit_85.jpg'
+    '''
+    for v in args:
+        if v:
+            name += '_%s' % v
+    name += fm
+    return name
+
+def thumbnail_paths(config, filename, thumbname, size, crop=None, bg=None,
+        quality=85, fmt=None):
+    '''Return original file, thumbnail file and thumbnail url
+
+    :param config: app config
+    :param filename: image digest - '2566a0e6538be8e094431ff46ae58950'
+    :param thumbname: file name image - 'test.jpg'
+    :param fmt: output format (FORMATS) or None to keep original format
+
+    Thumbnails are stored in MEDIA_CACHE_FOLDER/xx/yy/ subdirectories
+    from the hash of the thumbnail name.
+    '''
+    name, fm = os.path.splitext(thumbname)
+    if fmt:
+        # keep original extension in name: test.jpg and test.png differ
+        name, fm = name + fm.replace('.', '_'), FORMATS[fmt]
+    miniature = thumbnail_name(name, fm, size, crop, bg, quality)
+    # shard in subdirectories like the Tryton filestore
+    digest = hashlib.md5(miniature.encode('utf-8')
+        if isinstance(miniature, unicode) else miniature).hexdigest()
+    miniature = '/'.join((digest[0:2], digest[2:4], miniature))
+    original_filename = os.path.join(tryton_config['data_path'],
+        config['TRYTON_DATABASE'], filename[0:2], filename[2:4], filename)
+    thumb_filename = os.path.join(config['MEDIA_CACHE_FOLDER'], miniature)
+    thumb_url = os.path.join(config['MEDIA_CACHE_URL'], miniature)
+    return original_filename, thumb_filename, thumb_url
+
+def makedirs(path):
+    '''Create directory path if it does not exist'''
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def _bg_square(img, color=0xff):
+    size = (max(img.size),) * 2
+    layer = Image.new('L', size, color)
+    layer.paste(img, tuple(map(lambda x: (x[0] - x[1]) / 2, zip(size, img.size))))
+    return layer
+
+def output_format(fmt, accept=None):
+    '''Return thumbnail format: fmt ('jpeg', 'png', 'webp' or 'avif') if it
+    can be saved, or None to keep the original format.
+
+    With fmt 'auto' choose AVIF or WebP when accept (the list of mimetypes
+    accepted by the browser) names it; wildcards do not count.
+    '''
+    Image.init()
+    if fmt == 'auto':
+        for fmt in ('avif', 'webp'):
+            if accept and ('image/%s' % fmt) in accept and \
+                    fmt.upper() in Image.SAVE:
+                return fmt
+        return None
+    if fmt in FORMATS and fmt.upper() in Image.SAVE:
+        return fmt
+    return None
+
+def generate(original, target, width, height, crop=None, bg=None,
+        quality=85, fmt=None, max_pixels=None, progressive=False):
+    '''Create thumbnail file of original image. Return target or None if
+    original can not be read or it is bigger than max_pixels
+
+    It does not depend on Flask so it can run in a worker process. The
+    image is saved to a temporary file renamed to target, so a thumbnail
+    is never served half written.
+
+    JPEG originals are decoded at a reduced scale (draft mode) close to
+    the thumbnail size, so big photos are never fully decoded.
+    '''
+    try:
+        image = Image.open(original)
+    except IOError:
+        return None
+    if max_pixels and image.size[0] * image.size[1] > max_pixels:
+        return None
+    if image.format == 'JPEG':
+        image.draft(image.mode, (width, height))
+    fmt = fmt.upper() if fmt else image.format
+
+    if crop == 'fit':
+        img = ImageOps.fit(image, (width, height), Image.ANTIALIAS)
+    else:
+        # image is ours, resize it in place
+        img = image
+        img.thumbnail((width, height), Image.ANTIALIAS)
+
+    if bg:
+        img = _bg_square(img, bg)
+
+    options = {'quality': quality}
+    if fmt == 'JPEG':
+        if img.mode not in ('RGB', 'L', 'CMYK'):
+            img = img.convert('RGB')
+        if progressive:
+            options.update(progressive=True, optimize=True)
+
+    makedirs(os.path.dirname(target))
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            img.save(f, fmt, **options)
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, target)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return target
+
+def generate_task(args):
+    '''Run generate() with args tuple. Return (target, target or None)'''
+    try:
+        return args[1], generate(*args)
+    except Exception:
+        return args[1], None
+
+
+class ThumbnailEngine(object):
+    '''Generate thumbnails out of the request
+
+    Thumbnails are generated by a pool of processes (DEFAULT_PROCESSES
+    when processes is None, synchronously when it is 0). Each thumbnail is
+    generated once: it is queued once in this process and other processes
+    are kept out by a lock file next to the target. Until it is written,
+    callers get the 'pending' state.
+
+    Existing thumbnails are kept in a bounded index, so the file system is
+    only checked on index misses or after INDEX_TIMEOUT. The index is
+    cleared when evict() removed thumbnails (EVICTION_KEY of the shared
+    cache, checked every EVICTION_CHECK seconds). Failed thumbnails
+    are tried again after FAILED_TIMEOUT (the original may be uploaded
+    later).
+    '''
+
+    def __init__(self, processes=None, cache=None, index_size=100000,
+            max_pixels=None, progressive=False):
+        if processes is None:
+            processes = DEFAULT_PROCESSES
+        self.processes = processes
+        self.cache = cache
+        self.max_pixels = max_pixels
+        self.progressive = progressive
+        # thumbnails known to exist: target -> time
+        self.index = LRUCache(index_size)
+        self.stats = dict.fromkeys(('hits', 'misses', 'failed'), 0)
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._eviction_version = None
+        self._eviction_checked = 0
+        # failed thumbnails: target -> time
+        self._failed = LRUCache(FAILED_SIZE)
+
+    def pool(self):
+        '''Return process pool, created again after a fork'''
+        if self._pid != os.getpid():
+            self._pool = multiprocessing.Pool(self.processes)
+            self._pid = os.getpid()
+            self._pending = set()
+        return self._pool
+
+    def _count(self, stat):
+        '''Count a thumbnail request. Counters are added to the shared
+        cache ('thumbnail-<stat>' keys) every STATS_FLUSH requests'''
+        with self._lock:
+            self.stats[stat] += 1
+            if self.cache is None or sum(self.stats.values()) < STATS_FLUSH:
+                return
+            stats, self.stats = self.stats, dict.fromkeys(self.stats, 0)
+        # counters are shared: skip in-process tier of TieredCache, and
+        # add with inc(), atomic on memcached and redis
+        cache = getattr(self.cache, 'backend', self.cache)
+        for key, value in stats.iteritems():
+            if not value:
+                continue
+            key = 'thumbnail-%s' % key
+            # memcached does not increment missing keys
+            cache.add(key, 0, timeout=0)
+            cache.inc(key, value)
+
+    def check_evictions(self):
+        '''Clear the index when thumbnails were evicted since last check'''
+        now = time.time()
+        if self.cache is None or now - self._eviction_checked < EVICTION_CHECK:
+            return
+        self._eviction_checked = now
+        version = getattr(self.cache, 'backend', self.cache).get(EVICTION_KEY)
+        if version != self._eviction_version:
+            self.index.clear()
+            self._eviction_version = version
+
+    def _acquire(self, target):
+        lock = target + '.lock'
+        try:
+            if time.time() - os.path.getmtime(lock) > LOCK_TIMEOUT:
+                os.remove(lock)
+        except OSError:
+            pass
+        try:
+            os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except OSError:
+            return False
+        return True
+
+    def _release(self, target):
+        try:
+            os.remove(target + '.lock')
+        except OSError:
+            pass
+
+    def _done(self, result):
+        target, filename = result
+        if filename:
+            self.index.set(target, time.time())
+            self._failed.delete(target)
+        else:
+            self._failed.set(target, time.time())
+        with self._lock:
+            self._pending.discard(target)
+        self._release(target)
+
+    def failed(self, target):
+        '''Return True if target failed less than FAILED_TIMEOUT ago'''
+        failed = self._failed.get(target)
+        if failed is None:
+            return False
+        if time.time() - failed < FAILED_TIMEOUT:
+            return True
+        self._failed.delete(target)
+        return False
+
+    def thumbnail(self, original, target, width, height, crop=None, bg=None,
+            quality=85, fmt=None):
+        '''Return 'done' when target exists, 'pending' while it is generated
+        and 'failed' when original can not be read'''
+        self.check_evictions()
+        checked = self.index.get(target)
+        if checked and time.time() - checked < INDEX_TIMEOUT:
+            self._count('hits')
+            return 'done'
+        if os.path.exists(target):
+            self.index.set(target, time.time())
+            self._count('hits')
+            return 'done'
+        if self.failed(target):
+            self._count('failed')
+            return 'failed'
+        self._count('misses')
+
+        args = (original, target, width, height, crop, bg, quality, fmt,
+            self.max_pixels, self.progressive)
+        makedirs(os.path.dirname(target))
+        if self.processes == 0:
+            if not self._acquire(target):
+                return 'pending'
+            self._done(generate_task(args))
+            return 'failed' if self.failed(target) else 'done'
+
+        with self._lock:
+            pool = self.pool()
+            if target in self._pending:
+                return 'pending'
+            if not self._acquire(target):
+                return 'pending'
+            self._pending.add(target)
+        pool.apply_async(generate_task, (args,), callback=self._done)
+        return 'pending'
+
+
+def cache_files(folder):
+    '''Return list of (last access, size, path) of thumbnails of folder'''
+    files = []
+    for root, _, filenames in os.walk(folder):
+        for filename in filenames:
+            if filename.startswith('.tmp') or filename.endswith('.lock'):
+                continue
+            path = os.path.join(root, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            # atime is not updated on noatime mounts
+            files.append((max(stat.st_atime, stat.st_mtime), stat.st_size,
+                    path))
+    return files
+
+def evict(folder, max_size, files=None, cache=None):
+    '''Remove least recently used thumbnails until folder is under 90% of
+    max_size bytes, and the subdirectories left empty. Return (removed
+    files, removed bytes)
+
+    The version of evictions is incremented in cache, so ThumbnailEngine
+    indexes of web processes are cleared.
+    '''
+    if files is None:
+        files = cache_files(folder)
+    total = sum(f[1] for f in files)
+    target = max_size * 0.9
+    removed = removed_size = 0
+    if total <= max_size:
+        return removed, removed_size
+    folders = set()
+    for _, size, path in sorted(files):
+        if total - removed_size <= target:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        removed += 1
+        removed_size += size
+        folders.add(os.path.dirname(path))
+    remove_empty_folders(folder, folders)
+    if removed and cache is not None:
+        cache = getattr(cache, 'backend', cache)
+        cache.add(EVICTION_KEY, 0, timeout=0)
+        cache.inc(EVICTION_KEY)
+    return removed, removed_size
+
+def remove_empty_folders(folder, folders):
+    '''Remove empty folders and their empty parents up to folder'''
+    root = os.path.abspath(folder)
+    for path in sorted(folders, reverse=True):
+        path = os.path.abspath(path)
+        while path.startswith(root + os.sep):
+            try:
+                os.rmdir(path)
+            except OSError:
+                # not empty
+                break
+            path = os.path.dirname(path)